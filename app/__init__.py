@@ -3,7 +3,6 @@ import logging
 from flask import Flask, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_redis import FlaskRedis
-from sqlalchemy import create_engine
 
 from app.config import get_env_var, DefaultConfig, TestConfig
 
@@ -17,8 +16,11 @@ app.debug = bool(get_env_var("DEBUG", "True"))
 
 db = SQLAlchemy(app)
 es = None
-redis_store = FlaskRedis(app)
-engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=False)
+redis_store = FlaskRedis(
+    app,
+    socket_timeout=app.config["REDIS_SOCKET_TIMEOUT"],
+    socket_connect_timeout=app.config["REDIS_SOCKET_CONNECT_TIMEOUT"],
+)
 
 try:
     from flask_debugtoolbar import DebugToolbarExtension
@@ -35,4 +37,4 @@ app.jinja_env.globals["static"] = lambda filename: url_for("static", filename=fi
 logger = logging.getLogger("elasticsearch")
 logger.setLevel(logging.ERROR)
 
-from app import views
+from app import compression, conditional, views
@@ -0,0 +1,437 @@
+"""
+ASGI application: the /ajax/* lookups are served with asyncio.
+
+Postgres is queried with asyncpg and the cache uses redis.asyncio, so a
+worker keeps many lookups in flight instead of blocking on each of them.
+Other paths (HTML pages) are passed to the Flask app. Cache keys and values
+are the same as in the sync views, both modes share the cache.
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker app.asgi:application
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+from time import perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.engine import URL, Row, make_url
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+    create_async_engine,
+)
+from sqlalchemy.sql.elements import TextClause
+
+from app import app, async_cache
+from app.async_cache import cached, get_data_versions
+from app.cache import Incomplete
+from app.compression import compress_asgi
+from app.conditional import (
+    NOT_CACHED_CACHE_CONTROL,
+    cache_control,
+    is_cacheable,
+    is_not_modified,
+    make_etag,
+)
+from app.metrics import REQUEST_LATENCY, REQUESTS
+from app.models import (
+    SET_STATEMENT_TIMEOUT,
+    Airport,
+    City,
+    CityName,
+    QueryTimeout,
+    Route,
+    is_query_canceled,
+)
+from app.replicas import available_replicas, get_replicas
+from app.resilience import Overloaded
+from app.serving import get_store
+from app.slow_queries import capture_slow_queries
+from app.timing import add_rows, current_timing, request_timing, timed
+
+log = logging.getLogger(__name__)
+
+# Engines are created on first use, inside the event loop of the worker.
+_engines: Optional[list[AsyncEngine]] = None
+
+
+def _async_engine(url: URL) -> AsyncEngine:
+    engine = create_async_engine(
+        url.set(drivername="postgresql+asyncpg"),
+        **app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+    )
+    capture_slow_queries(engine.sync_engine)
+    return engine
+
+
+def get_engines() -> list[AsyncEngine]:
+    """Engines of the replicas (in order of get_replicas) and the primary."""
+    global _engines  # pylint: disable=global-statement
+    if _engines is None:
+        urls = [replica.engine.url for replica in get_replicas()]
+        urls.append(make_url(app.config["SQLALCHEMY_DATABASE_URI"]))
+        _engines = [_async_engine(url) for url in urls]
+    return _engines
+
+
+async def shutdown() -> None:
+    """Close connections of the worker."""
+    global _engines  # pylint: disable=global-statement
+    if _engines is not None:
+        for engine in _engines:
+            await engine.dispose()
+    _engines = None
+    await async_cache.close()
+
+
+# Database, see app.replicas for the sync version.
+
+
+@asynccontextmanager
+async def read_connection() -> AsyncIterator[AsyncConnection]:
+    """
+    Connection to a healthy replica (round robin), the primary otherwise.
+
+    Circuit breakers of the sync replicas track health of the replicas,
+    they probe failed ones in the background.
+    """
+    *replicas, primary = get_engines()
+    for position, replica in available_replicas():
+        try:
+            conn = await replicas[position].connect()
+        except (DBAPIError, OSError):
+            replica.connection_failed()
+            continue
+
+        replica.breaker.record_success()
+        try:
+            yield conn
+        finally:
+            await conn.close()
+        return
+
+    async with primary.connect() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def read_session() -> AsyncIterator[AsyncSession]:
+    async with read_connection() as conn, AsyncSession(bind=conn) as session:
+        yield session
+
+
+async def execute_raw(query: str, statement: TextClause, params: dict) -> list[Row]:
+    """Run a read-only raw query with its statement timeout, on a replica."""
+    timeout = app.config["STATEMENT_TIMEOUT"][query]
+    async with read_connection() as conn:
+        await conn.execute(SET_STATEMENT_TIMEOUT, {"timeout": str(timeout)})
+        try:
+            with timed("sql"):
+                rows = (await conn.execute(statement, params)).fetchall()
+        except DBAPIError as e:
+            if is_query_canceled(e):
+                raise QueryTimeout(f"{query} query exceeded {timeout} ms") from e
+            raise
+
+    add_rows(len(rows))
+    return rows
+
+
+# Lookups, see app.views for the sync version. Elasticsearch isn't
+# configured (app.es is None), cities are looked up in the serving store or
+# PostgreSQL.
+
+
+def _store_lookup(lookup: str, *args: Any) -> Optional[list[dict]]:
+    """Run the lookup of the serving store, None if the store isn't used."""
+    with timed("serving"):
+        store = get_store()
+        return None if store is None else getattr(store, lookup)(*args)
+
+
+async def _from_store(lookup: str, *args: Any) -> Optional[list[dict]]:
+    # Keep the event loop free, large prefixes and areas scan a lot.
+    return await asyncio.to_thread(_store_lookup, lookup, *args)
+
+
+async def _autocomplete_cities(query: str) -> list[dict]:
+    result = await _from_store("autocomplete", query)
+    if result is not None:
+        return result
+
+    async with read_session() as session:
+        with timed("sql"):
+            cities = (await session.scalars(CityName.autocomplete_query(query))).all()
+        add_rows(len(cities))
+        return [city.autocomplete_serialize() for city in cities]
+
+
+async def _closest_city(lat: float, lng: float) -> Optional[dict]:
+    raw_data = await execute_raw(
+        "closest_cities", *City.closest_cities_query(lat, lng, 1)
+    )
+    return next(iter(City.closest_cities_serialize(raw_data)), None)
+
+
+async def _nearby_airports(lat: float, lng: float, limit: int) -> list[dict]:
+    result = await _from_store("closest_airports", lat, lng, limit)
+    if result is not None:
+        return result
+
+    raw_data = await execute_raw(
+        "closest_airports", *Airport.closest_airports_query(lat, lng, limit)
+    )
+    return [row._asdict() for row in raw_data]
+
+
+async def _closest_airports(
+    lat: float, lng: float, limit: int, find_closest_city: bool
+) -> dict[str, Any] | Incomplete:
+    nearby_lookup = _nearby_airports(lat, lng, limit)
+    if not find_closest_city:
+        return {"airports": await nearby_lookup}
+
+    closest_city = asyncio.ensure_future(
+        asyncio.wait_for(_closest_city(lat, lng), app.config["CLOSEST_CITY_TIMEOUT"])
+    )
+    try:
+        nearby = await nearby_lookup
+        try:
+            city = await closest_city
+        except asyncio.TimeoutError:
+            # Answer without the city, don't cache the incomplete result.
+            return Incomplete({"airports": nearby, "closest_city": None})
+    finally:
+        closest_city.cancel()
+
+    return {"airports": nearby, "closest_city": city}
+
+
+async def _routes(from_airport: int, to_airport: int) -> dict[str, dict]:
+    raw_data = await execute_raw(
+        "route_path", *Route.path_query(from_airport, to_airport)
+    )
+    async with read_session() as session:
+        with timed("sql"):
+            query = Route.path_airports_query(raw_data)
+            path_airports = (await session.execute(query)).all()
+
+    return Route.group_paths(raw_data, path_airports)
+
+
+async def _cities_in_area(
+    ne_lng: float, ne_lat: float, sw_lng: float, sw_lat: float
+) -> list[dict]:
+    result = await _from_store("cities_in_area", ne_lng, ne_lat, sw_lng, sw_lat)
+    if result is not None:
+        return result
+
+    async with read_session() as session:
+        with timed("sql"):
+            cities = await session.scalars(
+                City.in_area_query(ne_lng, ne_lat, sw_lng, sw_lat)
+            )
+            result = [city.serialize() for city in cities.unique()]
+        add_rows(len(result))
+        return result
+
+
+# Routing.
+
+
+def _autocomplete_cities_args(args: dict[str, str]) -> tuple:
+    return (args["query"],)
+
+
+async def autocomplete_cities(query: str) -> dict[str, Any]:
+    return {
+        "suggestions": await cached(
+            "autocomplete_cities", (query,), lambda: _autocomplete_cities(query)
+        )
+    }
+
+
+def _airports_args(args: dict[str, str]) -> tuple:
+    return (
+        float(args["lat"]),
+        float(args["lng"]),
+        int(args["limit"]) or 1,
+        args.get("find_closest_city") == "true",
+    )
+
+
+async def airports(
+    lat: float, lng: float, limit: int, find_closest_city: bool
+) -> dict[str, Any]:
+    return await cached(
+        "airports",
+        (lat, lng, limit, find_closest_city),
+        lambda: _closest_airports(lat, lng, limit, find_closest_city),
+    )
+
+
+def _routes_args(args: dict[str, str]) -> tuple:
+    return (
+        int(args["from_airport"]),
+        int(args["to_airport"]),
+        args.get("format") == "normalized",
+    )
+
+
+async def routes(from_airport: int, to_airport: int, normalized: bool) -> dict:
+    result = await cached(
+        "routes", (from_airport, to_airport), lambda: _routes(from_airport, to_airport)
+    )
+    if normalized:
+        return result
+    return {"routes": Route.denormalize_paths(result)}
+
+
+def _get_cities_args(args: dict[str, str]) -> tuple:
+    return tuple(float(args[name]) for name in ("ne_lng", "ne_lat", "sw_lng", "sw_lat"))
+
+
+async def get_cities(
+    ne_lng: float, ne_lat: float, sw_lng: float, sw_lat: float
+) -> dict[str, Any]:
+    area = (ne_lng, ne_lat, sw_lng, sw_lat)
+    return {
+        "json_list": await cached(
+            "get_cities", area, lambda: _cities_in_area(ne_lng, ne_lat, sw_lng, sw_lat)
+        )
+    }
+
+
+# Lookups by path, with parsers of their arguments (KeyError or ValueError
+# if they are invalid).
+ROUTES: dict[
+    str,
+    tuple[Callable[[dict[str, str]], tuple], Callable[..., Awaitable[dict[str, Any]]]],
+] = {
+    "/ajax/autocomplete/cities": (_autocomplete_cities_args, autocomplete_cities),
+    "/ajax/airports": (_airports_args, airports),
+    "/ajax/routes": (_routes_args, routes),
+    "/ajax/get-cities": (_get_cities_args, get_cities),
+}
+
+flask_application = WsgiToAsgi(app)
+
+
+async def _send(
+    scope: dict, send: Callable, status: int, body: bytes, headers: list
+) -> int:
+    """Send the response with its Server-Timing, return its status."""
+    timing = current_timing()
+    headers.append((b"server-timing", timing.header().encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+    timing.log(scope["path"], status, len(body))
+    return status
+
+
+async def _respond(
+    scope: dict,
+    send: Callable,
+    status: int,
+    data: dict[str, Any],
+    headers: tuple = (),
+) -> int:
+    body, encoding_headers = compress_asgi(
+        app.json.dumps(data).encode(), scope["headers"]
+    )
+    return await _send(
+        scope,
+        send,
+        status,
+        body,
+        [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            *encoding_headers,
+            *headers,
+        ],
+    )
+
+
+async def _lifespan(receive: Callable, send: Callable) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _serve(scope: dict, send: Callable, namespace: str) -> int:
+    """Answer the lookup request, return status of the response."""
+    query_string = parse_qs(scope["query_string"].decode("latin-1"))
+    args = {name: values[0] for name, values in query_string.items()}
+    parse, lookup = ROUTES[scope["path"]]
+    try:
+        params = parse(args)
+    except (KeyError, ValueError):
+        return await _respond(scope, send, 400, {"error": "Invalid parameters."})
+
+    versions = await get_data_versions(app.config["CACHE_DEPENDENCIES"][namespace])
+    etag = make_etag(namespace, versions, args)
+    validators = (
+        (b"etag", f'W/"{etag}"'.encode()),
+        (b"cache-control", cache_control(namespace).encode()),
+    )
+    if_none_match = dict(scope["headers"]).get(b"if-none-match", b"")
+    if is_not_modified(if_none_match.decode("latin-1"), etag):
+        return await _send(scope, send, 304, b"", list(validators))
+
+    # Other errors are logged by the server and answered with 500.
+    try:
+        data = await lookup(*params)
+    except QueryTimeout:
+        return await _respond(
+            scope,
+            send,
+            503,
+            {"error": "Query timed out, try again later."},
+            ((b"retry-after", b"5"),),
+        )
+    except (Overloaded, PoolTimeout):
+        return await _respond(
+            scope,
+            send,
+            503,
+            {"error": "Server is busy, try again later."},
+            ((b"retry-after", b"5"),),
+        )
+    if not is_cacheable():
+        validators = ((b"cache-control", NOT_CACHED_CACHE_CONTROL.encode()),)
+    return await _respond(scope, send, 200, data, validators)
+
+
+async def application(scope: dict, receive: Callable, send: Callable) -> None:
+    """Serve the lookups, pass everything else to Flask."""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+
+    route = ROUTES.get(scope["path"]) if scope["type"] == "http" else None
+    if route is None or scope["method"] != "GET":
+        await flask_application(scope, receive, send)
+        return
+
+    # Same metrics as Flask requests (app.metrics), endpoints are namespaces.
+    namespace = route[1].__name__
+    status = 500
+    with request_timing() as timing:
+        try:
+            status = await _serve(scope, send, namespace)
+        finally:
+            REQUEST_LATENCY.labels(namespace).observe(perf_counter() - timing.start)
+            REQUESTS.labels(namespace, status).inc()
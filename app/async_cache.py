@@ -0,0 +1,246 @@
+"""
+asyncio version of the cache layer (app.cache) for the ASGI app.
+
+Keys, values, TTLs, locks and the handling of overload are those of
+app.cache, both versions share the cache. Only Redis I/O is different: it's
+done with redis.asyncio, and concurrent misses of the worker share a task
+instead of a thread lock.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager, nullcontext
+import pickle
+from time import perf_counter
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Optional,
+)
+from uuid import uuid4
+
+from redis import asyncio as aioredis
+
+from app import app
+from app.cache import (
+    RELEASE_LOCK_SCRIPT,
+    Incomplete,
+    cache_metrics,
+    data_versions,
+    data_version_keys,
+    dump_value,
+    format_key,
+    get_local,
+    load_value,
+    lock_key,
+    lock_polls,
+    make_stale_key,
+    redis_breaker,
+    redis_call,
+    redis_ttl,
+    remember_data_versions,
+    shed_load,
+)
+from app.resilience import AdmissionQueue, Overloaded
+from app.timing import note
+
+# The client is created on first use, inside the event loop of the worker.
+_redis: Optional[aioredis.Redis] = None
+_admission_limits: Optional[dict[str, AsyncAdmissionLimit]] = None
+# Computations of missed keys, requests of the worker missing a key share one.
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def get_redis() -> aioredis.Redis:
+    global _redis  # pylint: disable=global-statement
+    if _redis is None:
+        _redis = aioredis.from_url(
+            app.config["REDIS_URL"],
+            socket_timeout=app.config["REDIS_SOCKET_TIMEOUT"],
+            socket_connect_timeout=app.config["REDIS_SOCKET_CONNECT_TIMEOUT"],
+        )
+    return _redis
+
+
+async def close() -> None:
+    """Close the Redis client, drop state bound to the event loop."""
+    global _redis, _admission_limits  # pylint: disable=global-statement
+    if _redis is not None:
+        await _redis.aclose()
+    _redis = _admission_limits = None
+
+
+class AsyncAdmissionLimit(AdmissionQueue):
+    """asyncio version of app.resilience.AdmissionLimit."""
+
+    def __init__(self, concurrency: int, queue_size: int) -> None:
+        super().__init__(queue_size)
+        self._slots = asyncio.Semaphore(concurrency)
+
+    @asynccontextmanager
+    async def slot(self, timeout: float) -> AsyncIterator[None]:
+        """Wait up to `timeout` seconds for a free slot, raise Overloaded if none."""
+        if self._slots.locked():
+            with self.queued():
+                try:
+                    await asyncio.wait_for(self._slots.acquire(), timeout)
+                except asyncio.TimeoutError as e:
+                    raise Overloaded(f"no free slot in {timeout} s") from e
+        else:
+            await self._slots.acquire()
+
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+def _admit(namespace: str) -> AsyncContextManager[None]:
+    global _admission_limits  # pylint: disable=global-statement
+    if _admission_limits is None:
+        _admission_limits = {
+            name: AsyncAdmissionLimit(*limits)
+            for name, limits in app.config["ADMISSION_LIMITS"].items()
+        }
+    limit = _admission_limits.get(namespace)
+    return limit.slot(app.config["ADMISSION_WAIT"]) if limit else nullcontext()
+
+
+async def get_data_versions(names: tuple[str, ...]) -> list[int]:
+    result = data_versions.get(names)
+    if result is not None:
+        return result
+
+    values = None
+    if redis_breaker.available:
+        with redis_call():
+            values = await get_redis().mget(data_version_keys(names))
+    return remember_data_versions(names, values)
+
+
+async def cache_get(key: str, namespace: str) -> Any:
+    result = get_local(key)
+    if result is not None or not redis_breaker.available:
+        return result
+
+    payload = None
+    with redis_call(namespace):
+        payload = await get_redis().get(key)
+    return load_value(key, payload, namespace)
+
+
+async def cache_set(key: str, value: Any, namespace: str) -> int:
+    payload = dump_value(key, value, namespace)
+    if redis_breaker.available:
+        with redis_call(namespace):
+            await get_redis().set(key, payload, redis_ttl(namespace))
+    return len(payload)
+
+
+async def cache_set_stale(key: str, value: Any, namespace: str) -> None:
+    if redis_breaker.available:
+        with redis_call():
+            await get_redis().set(
+                key, pickle.dumps(value), app.config["CACHE_STALE_TTL"][namespace]
+            )
+
+
+async def _wait_for(key: str, namespace: str) -> Any:
+    """Wait until another worker caches the key."""
+    for delay in lock_polls():
+        await asyncio.sleep(delay)
+        result = await cache_get(key, namespace)
+        if result is not None:
+            return result
+
+    return None
+
+
+async def _compute(
+    key: str,
+    namespace: str,
+    compute: Callable[[], Awaitable[Any]],
+    stale_key: Optional[str],
+) -> tuple[Any, Optional[str]]:
+    """
+    Compute and cache the key, unless the holder of the Redis lock does it.
+
+    Return the value and why it isn't cached ("stale" or "incomplete"), for
+    requests waiting for it.
+    """
+    token = uuid4().hex
+    # Compute it without the lock if Redis fails.
+    leader, acquired = True, False
+    if redis_breaker.available:
+        with redis_call():
+            leader = acquired = bool(
+                await get_redis().set(
+                    lock_key(key), token, nx=True, ex=app.config["CACHE_LOCK_TIMEOUT"]
+                )
+            )
+
+    if not leader:
+        result = await _wait_for(key, namespace)
+        if result is not None:
+            cache_metrics.record_hit(namespace)
+            note(cache="wait")
+            return result, None
+
+    note(cache="miss")
+    try:
+        try:
+            async with _admit(namespace):
+                start = perf_counter()
+                result = await compute()
+                duration = perf_counter() - start
+        except Overloaded as e:
+            stale = await cache_get(stale_key, namespace) if stale_key else None
+            return shed_load(namespace, stale, e), "stale"
+
+        not_cached = None
+        if isinstance(result, Incomplete):
+            note(cache="incomplete")
+            result, payload_size, not_cached = result.value, 0, "incomplete"
+        else:
+            payload_size = await cache_set(key, result, namespace)
+            if stale_key:
+                await cache_set_stale(stale_key, result, namespace)
+    finally:
+        if acquired:
+            with redis_call():
+                await get_redis().eval(RELEASE_LOCK_SCRIPT, 1, lock_key(key), token)
+
+    cache_metrics.record_miss(namespace, duration, payload_size)
+    return result, not_cached
+
+
+async def cached(
+    namespace: str, args: tuple, compute: Callable[[], Awaitable[Any]]
+) -> Any:
+    """Get the result from the cache or compute and cache it."""
+    versions = await get_data_versions(app.config["CACHE_DEPENDENCIES"][namespace])
+    key = format_key(namespace, versions, args)
+    result = await cache_get(key, namespace)
+    if result is not None:
+        cache_metrics.record_hit(namespace)
+        return result
+
+    task = _inflight.get(key)
+    if task is not None:
+        result, not_cached = await asyncio.shield(task)
+        cache_metrics.record_hit(namespace)
+        note(cache=not_cached or "coalesced")
+        return result
+
+    task = asyncio.ensure_future(
+        _compute(key, namespace, compute, make_stale_key(namespace, *args))
+    )
+    _inflight[key] = task
+    task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # A disconnected client doesn't cancel the lookup other requests wait for.
+    result, _ = await asyncio.shield(task)
+    return result
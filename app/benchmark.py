@@ -0,0 +1,190 @@
+"""
+Benchmarks of the hot query paths and /ajax views.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timezone
+import platform
+import statistics
+import subprocess
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+from sqlalchemy.sql import text
+
+from app import app, db, redis_store
+from app.cache import local_cache, make_key
+from app.models import Airport, City, QueryTimeout, Route, get_distance
+
+# Lviv, a point with airports and cities around.
+LAT, LNG = 49.84, 24.03
+
+
+def measure(
+    f: Callable[[], Any],
+    repeat: int,
+    number: int = 1,
+    setup: Optional[Callable[[], Any]] = None,
+) -> dict[str, float]:
+    """Per-call timings (in ms) of `repeat` samples of `number` calls each."""
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = perf_counter()
+        try:
+            for _ in range(number):
+                f()
+        except QueryTimeout as e:
+            return {"samples": len(samples), "error": str(e)}
+        samples.append((perf_counter() - start) * 1000 / number)
+
+    samples.sort()
+    return {
+        "samples": repeat,
+        "calls_per_sample": number,
+        "min_ms": round(samples[0], 4),
+        "median_ms": round(statistics.median(samples), 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+        "max_ms": round(samples[-1], 4),
+    }
+
+
+def route_pairs() -> dict[str, tuple[int, int]]:
+    """Airports with the most routes and a route between barely connected ones."""
+    with db.engine.connect() as conn:
+        hubs = (
+            conn.execute(
+                text(
+                    "SELECT source FROM route GROUP BY source "
+                    "ORDER BY count(*) DESC, source LIMIT 2"
+                )
+            )
+            .scalars()
+            .all()
+        )
+        sparse = conn.execute(
+            text(
+                "SELECT route.source, route.destination FROM route "
+                "JOIN (SELECT source, count(*) AS routes FROM route GROUP BY source) "
+                "AS degree ON degree.source = route.source "
+                "ORDER BY degree.routes, route.source, route.destination LIMIT 1"
+            )
+        ).first()
+
+    pairs = {}
+    if len(hubs) == 2:
+        pairs["hub"] = (hubs[0], hubs[1])
+    if sparse:
+        pairs["sparse"] = (sparse.source, sparse.destination)
+    return pairs
+
+
+def _drop_cached(namespace: str, args: tuple) -> Callable[[], None]:
+    """Remove the cached result of a view, so the next call is cold."""
+
+    def drop() -> None:
+        key = make_key(namespace, *args)
+        local_cache.delete(key)
+        redis_store.delete(key)
+
+    return drop
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _database_info() -> dict[str, Any]:
+    """PostgreSQL version and rows of the tables, the data measured."""
+    with db.engine.connect() as conn:
+        return {
+            "postgres": conn.execute(text("SHOW server_version")).scalar(),
+            "rows": {
+                table: conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+                for table in ("airline", "airport", "route", "city", "cityname")
+            },
+        }
+
+
+def run_benchmark(repeat: int = 20) -> dict[str, Any]:
+    """Time the query paths and views, return the report."""
+    results: dict[str, Any] = {
+        "get_distance": measure(
+            lambda: get_distance(LAT, LNG, 50.45, 30.52), repeat, number=10000
+        ),
+        "get_closest_airports": measure(
+            lambda: Airport.get_closest_airports(LAT, LNG, 5), repeat
+        ),
+        "get_closest_cities": measure(
+            lambda: City.get_closest_cities(LAT, LNG, 5), repeat
+        ),
+    }
+
+    pairs = route_pairs()
+    for name, (source, destination) in pairs.items():
+        results[f"get_path_{name}"] = measure(
+            lambda s=source, d=destination: Route.get_path(s, d), repeat
+        )
+
+    # Name, cache namespace, URL and arguments of the cached view function.
+    views = [
+        (
+            "autocomplete_cities",
+            "autocomplete_cities",
+            "/ajax/autocomplete/cities?query=Lv",
+            ("Lv",),
+        ),
+        (
+            "airports",
+            "airports",
+            f"/ajax/airports?lat={LAT}&lng={LNG}&limit=5&find_closest_city=true",
+            (LAT, LNG, 5, True),
+        ),
+        (
+            "get_cities",
+            "get_cities",
+            "/ajax/get-cities?ne_lng=25.0&ne_lat=51.0&sw_lng=23.0&sw_lat=49.0",
+            (25.0, 51.0, 23.0, 49.0),
+        ),
+    ]
+    views.extend(
+        (
+            f"routes_{name}",
+            "routes",
+            f"/ajax/routes?from_airport={source}&to_airport={destination}",
+            (source, destination),
+        )
+        for name, (source, destination) in pairs.items()
+    )
+
+    client = app.test_client()
+    for name, namespace, url, args in views:
+        for cache in ("cold", "warm"):
+            statuses: set[int] = set()
+            results[f"view_{name}_{cache}"] = measure(
+                lambda u=url, s=statuses: s.add(client.get(u).status_code),
+                repeat,
+                setup=_drop_cached(namespace, args) if cache == "cold" else None,
+            )
+            # Errors (e.g. 503 on a query timeout) aren't cached.
+            results[f"view_{name}_{cache}"]["statuses"] = sorted(statuses)
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        **_database_info(),
+        "engine_options": app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+        "route_pairs": pairs,
+        "results": results,
+    }
@@ -0,0 +1,490 @@
+"""
+Cache layer: a per-worker in-memory LRU in front of Redis.
+
+Use the `cached` decorator to cache results of a function, every cached
+namespace must have a TTL in CACHE_TTL and LOCAL_CACHE_TTL settings.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+import pickle
+import random
+import threading
+from time import monotonic, perf_counter, sleep
+from typing import Any, Callable, ContextManager, Hashable, Iterator, Optional
+from urllib.parse import quote
+from uuid import uuid4
+from weakref import WeakValueDictionary
+
+from redis.exceptions import (
+    ConnectionError as RedisConnectionError,
+    TimeoutError as RedisTimeoutError,
+)
+
+from app import app, redis_store
+from app.metrics import (
+    CACHE_MISS_DURATION,
+    CACHE_PAYLOAD_BYTES,
+    CACHE_REQUESTS,
+    LOAD_SHED,
+    LOCAL_CACHE_ITEMS,
+)
+from app.resilience import AdmissionLimit, CircuitBreaker, Overloaded
+from app.timing import note, timed
+
+
+class LRUCache:
+    """Bounded in-process LRU cache with per-item TTL."""
+
+    def __init__(self, max_size: int = 1024) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        """Get not expired value or None."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < monotonic():
+                if item is not None:
+                    del self._data[key]  # expired
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        """Set value, evict the least recently used items if needed."""
+        if self.max_size <= 0 or ttl <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        """Delete value."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all items and reset statistics."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict[str, Any]:
+        """Hit/miss statistics."""
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / requests if requests else 0.0,
+        }
+
+
+class CacheMetrics:
+    """Per-namespace cache metrics, exported on /metrics (see app.metrics)."""
+
+    def record_hit(self, namespace: str) -> None:
+        CACHE_REQUESTS.labels(namespace, "hit").inc()
+
+    def record_miss(self, namespace: str, seconds: float, payload_size: int) -> None:
+        CACHE_REQUESTS.labels(namespace, "miss").inc()
+        CACHE_MISS_DURATION.labels(namespace).observe(seconds)
+        # Incomplete results aren't cached, they have no payload.
+        if payload_size:
+            CACHE_PAYLOAD_BYTES.labels(namespace).observe(payload_size)
+
+    def record_error(self, namespace: str) -> None:
+        """Redis failed to get or set a value of the namespace."""
+        CACHE_REQUESTS.labels(namespace, "error").inc()
+
+
+class Incomplete:
+    """Result of a computation that is returned but not cached."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+
+
+local_cache = LRUCache(app.config["LOCAL_CACHE_MAX_SIZE"])
+data_versions = LRUCache()
+# The last versions got from Redis, used while it's unavailable.
+known_data_versions: dict[tuple[str, ...], list[int]] = {}
+# Misses are computed on the primary until then (monotonic time).
+_replicas_lag_until = 0.0
+DATA_BUMPED_KEY = "data_version|bumped"
+cache_metrics = CacheMetrics()
+redis_breaker = CircuitBreaker(
+    redis_store.ping,
+    app.config["REDIS_CIRCUIT_FAILURE_THRESHOLD"],
+    app.config["REDIS_CIRCUIT_BACKOFF"],
+    app.config["REDIS_CIRCUIT_MAX_BACKOFF"],
+)
+
+admission_limits = {
+    namespace: AdmissionLimit(*limits)
+    for namespace, limits in app.config["ADMISSION_LIMITS"].items()
+}
+
+# Locks of keys that are being computed by threads of this worker.
+_local_locks: WeakValueDictionary[str, threading.Lock] = WeakValueDictionary()
+_local_locks_guard = threading.Lock()
+
+# Delete the lock only if it's still ours (it could expire and be taken).
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+# Seconds between checks for the value computed by the holder of the lock.
+LOCK_POLL_INTERVAL = 0.05
+
+
+# Policies shared with the asyncio version (app.async_cache), I/O is below.
+
+
+@contextmanager
+def redis_call(namespace: Optional[str] = None) -> Iterator[None]:
+    """
+    Time Redis calls of the block and track health of Redis.
+
+    Connection errors are swallowed (the cache is optional), the rest of the
+    block is skipped and the caller goes on with its default.
+    """
+    try:
+        with timed("redis"):
+            yield
+    except (RedisConnectionError, RedisTimeoutError):
+        redis_breaker.record_failure()
+        if namespace:
+            cache_metrics.record_error(namespace)
+    else:
+        redis_breaker.record_success()
+
+
+def _jittered(ttl: float) -> float:
+    """Spread expiration of keys that were cached at the same time."""
+    return ttl * (1 - random.uniform(0, app.config["CACHE_TTL_JITTER"]))
+
+
+def redis_ttl(namespace: str) -> int:
+    """TTL of a value of the namespace in Redis."""
+    return int(_jittered(app.config["CACHE_TTL"][namespace]))
+
+
+def cache_local(key: str, value: Any, namespace: str) -> None:
+    """Save value to the local cache of the worker."""
+    local_cache.set(key, value, _jittered(app.config["LOCAL_CACHE_TTL"][namespace]))
+    LOCAL_CACHE_ITEMS.labels("results").set(len(local_cache))
+
+
+def get_local(key: str) -> Any:
+    """Get value from the local cache of the worker."""
+    result = local_cache.get(key)
+    if result is not None:
+        note(cache="local")
+    return result
+
+
+def load_value(key: str, payload: Optional[bytes], namespace: str) -> Any:
+    """Unpickle value got from Redis, keep it in the local cache."""
+    if not payload:
+        return None
+
+    result = pickle.loads(payload)
+    cache_local(key, result, namespace)
+    note(cache="redis")
+    return result
+
+
+def dump_value(key: str, value: Any, namespace: str) -> bytes:
+    """Keep value in the local cache, pickle it for Redis."""
+    cache_local(key, value, namespace)
+    return pickle.dumps(value)
+
+
+def lock_key(key: str) -> str:
+    """Redis lock of the key held by the worker computing it."""
+    return f"lock|{key}"
+
+
+def lock_polls() -> Iterator[float]:
+    """Delays between checks for the value computed by the holder of the lock."""
+    deadline = monotonic() + app.config["CACHE_LOCK_WAIT"]
+    while monotonic() < deadline and redis_breaker.available:
+        yield LOCK_POLL_INTERVAL
+
+
+def shed_load(namespace: str, stale: Any, error: Overloaded) -> Any:
+    """Answer an overloaded namespace with the stale value, raise error if none."""
+    LOAD_SHED.labels(namespace, "error" if stale is None else "stale").inc()
+    if stale is None:
+        raise error
+    note(cache="stale")
+    return stale
+
+
+# Redis I/O.
+
+
+def cache_get(key: str, namespace: str) -> Any:
+    """Get value from the local cache, then from Redis (if it's available)."""
+    result = get_local(key)
+    if result is not None or not redis_breaker.available:
+        return result
+
+    payload = None
+    with redis_call(namespace):
+        payload = redis_store.get(key)
+    return load_value(key, payload, namespace)
+
+
+def cache_set(key: str, value: Any, namespace: str) -> int:
+    """Save value locally and to Redis (if available), return the payload size."""
+    payload = dump_value(key, value, namespace)
+    if redis_breaker.available:
+        with redis_call(namespace):
+            redis_store.set(key, payload, redis_ttl(namespace))
+    return len(payload)
+
+
+def cache_set_stale(key: str, value: Any, namespace: str) -> None:
+    """Save the last computed value to Redis, it's served under overload."""
+    if redis_breaker.available:
+        with redis_call():
+            redis_store.set(
+                key, pickle.dumps(value), app.config["CACHE_STALE_TTL"][namespace]
+            )
+
+
+@contextmanager
+def single_flight(key: str) -> Iterator[bool]:
+    """
+    Let only one worker compute the key.
+
+    Yield True if the caller holds the Redis lock (or Redis is unavailable)
+    and should compute the value, False if another worker is computing it.
+    """
+    token = uuid4().hex
+    # Compute it without the lock if Redis fails.
+    leader, acquired = True, False
+    if redis_breaker.available:
+        with redis_call():
+            leader = acquired = bool(
+                redis_store.set(
+                    lock_key(key), token, nx=True, ex=app.config["CACHE_LOCK_TIMEOUT"]
+                )
+            )
+
+    try:
+        yield leader
+    finally:
+        if acquired:
+            with redis_call():
+                redis_store.eval(RELEASE_LOCK_SCRIPT, 1, lock_key(key), token)
+
+
+def _wait_for(key: str, namespace: str) -> Any:
+    """Wait until another worker caches the key."""
+    for delay in lock_polls():
+        sleep(delay)
+        result = cache_get(key, namespace)
+        if result is not None:
+            return result
+
+    return None
+
+
+def _admit(namespace: str) -> ContextManager[None]:
+    limit = admission_limits.get(namespace)
+    return limit.slot(app.config["ADMISSION_WAIT"]) if limit else nullcontext()
+
+
+def cache_get_or_set(
+    key: str,
+    namespace: str,
+    compute: Callable[[], Any],
+    stale_key: Optional[str] = None,
+) -> Any:
+    """
+    Get value from the cache or compute and cache it.
+
+    Concurrent misses of the same key are coalesced: threads of the worker
+    wait for each other and workers wait for the holder of the Redis lock,
+    so the expensive computation runs once.
+
+    Computations are limited by ADMISSION_LIMITS of the namespace (hits
+    aren't), when it's overloaded the value cached at `stale_key` by a
+    previous computation is returned, Overloaded is raised if there is none.
+
+    Wrap a result in Incomplete to return it without caching.
+    """
+    result = cache_get(key, namespace)
+    if result is not None:
+        cache_metrics.record_hit(namespace)
+        return result
+
+    with _local_locks_guard:
+        lock = _local_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        # Another thread could compute it while we were waiting for the lock.
+        result = local_cache.get(key)
+        if result is not None:
+            cache_metrics.record_hit(namespace)
+            note(cache="coalesced")
+            return result
+
+        with single_flight(key) as leader:
+            if not leader:
+                result = _wait_for(key, namespace)
+                if result is not None:
+                    cache_metrics.record_hit(namespace)
+                    note(cache="wait")
+                    return result
+
+            note(cache="miss")
+            try:
+                with _admit(namespace):
+                    start = perf_counter()
+                    result = compute()
+                    duration = perf_counter() - start
+            except Overloaded as e:
+                stale = cache_get(stale_key, namespace) if stale_key else None
+                return shed_load(namespace, stale, e)
+
+            if isinstance(result, Incomplete):
+                note(cache="incomplete")
+                result, payload_size = result.value, 0
+            else:
+                payload_size = cache_set(key, result, namespace)
+                if stale_key:
+                    cache_set_stale(stale_key, result, namespace)
+
+    cache_metrics.record_miss(namespace, duration, payload_size)
+    return result
+
+
+def _normalize(value: Any) -> str:
+    """Canonical representation of a cache key argument."""
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        # 49, 49.0 and 49.0000001 are the same point.
+        return repr(round(value, 6) + 0.0)
+    return quote(str(value), safe="")
+
+
+def get_data_versions(names: tuple[str, ...]) -> list[int]:
+    """Get versions of imported data, they are cached for DATA_VERSION_TTL."""
+    result = data_versions.get(names)
+    if result is not None:
+        return result
+
+    values = None
+    if redis_breaker.available:
+        with redis_call():
+            values = redis_store.mget(data_version_keys(names))
+    return remember_data_versions(names, values)
+
+
+def data_version_keys(names: tuple[str, ...]) -> list[str]:
+    # The last one is set for a while after imports (see replicas_may_lag).
+    return [f"data_version|{name}" for name in names] + [DATA_BUMPED_KEY]
+
+
+def replicas_may_lag() -> bool:
+    """Data was imported recently, replicas may not have it yet."""
+    return monotonic() < _replicas_lag_until
+
+
+def remember_data_versions(
+    names: tuple[str, ...], values: Optional[list[Optional[bytes]]]
+) -> list[int]:
+    """Versions got from Redis (None if it's unavailable), cached by the worker."""
+    global _replicas_lag_until  # pylint: disable=global-statement
+    if values is None:
+        # Unknown versions aren't a change of the data.
+        result = known_data_versions.get(names, [0] * len(names))
+    else:
+        *versions, bumped = values
+        if bumped:
+            _replicas_lag_until = monotonic() + app.config["REPLICA_MAX_LAG"]
+        result = [int(version or 0) for version in versions]
+        known_data_versions[names] = result
+    data_versions.set(names, result, app.config["DATA_VERSION_TTL"])
+    return result
+
+
+def bump_data_version(*names: str) -> None:
+    """
+    Invalidate cached values that depend on the data (see CACHE_DEPENDENCIES).
+
+    Old values aren't deleted, they just aren't used anymore and expire.
+    """
+    for name in names:
+        redis_store.incr(f"data_version|{name}")
+    redis_store.set(DATA_BUMPED_KEY, 1, ex=app.config["REPLICA_MAX_LAG"])
+    data_versions.clear()
+
+
+def format_key(namespace: str, versions: list[int], args: tuple) -> str:
+    """Build cache key: namespace|version|data versions|arg1|arg2..."""
+    data_version = ".".join(str(version) for version in versions)
+    return "|".join(
+        [namespace, f"v{app.config['CACHE_KEY_VERSION']}", data_version]
+        + [_normalize(arg) for arg in args]
+    )
+
+
+def make_stale_key(namespace: str, *args: Any) -> Optional[str]:
+    """Key of the last computed value regardless of data versions, if it's kept."""
+    if namespace not in app.config["CACHE_STALE_TTL"]:
+        return None
+    return "stale|" + format_key(namespace, [], args)
+
+
+def make_key(namespace: str, *args: Any) -> str:
+    """Cache key of the arguments and current versions of the namespace data."""
+    versions = get_data_versions(app.config["CACHE_DEPENDENCIES"][namespace])
+    return format_key(namespace, versions, args)
+
+
+def cached(namespace: str) -> Callable:
+    """Cache results of the function (positional arguments only)."""
+
+    def decorator(f: Callable) -> Callable:
+        @wraps(f)
+        def wrap(*args: Any) -> Any:
+            return cache_get_or_set(
+                make_key(namespace, *args),
+                namespace,
+                lambda: f(*args),
+                make_stale_key(namespace, *args),
+            )
+
+        return wrap
+
+    return decorator
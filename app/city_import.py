@@ -0,0 +1,283 @@
+"""
+Import of the worldcities CSV in a single parallel pass (see import_cities).
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import csv
+from itertools import islice
+import math
+import os
+from typing import Iterator
+
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import text
+
+from app import db
+from app.importers import copy_rows, upsert_query
+from app.progress import ImportProgress
+
+CITY_COLUMNS = (
+    "seq",
+    "gns_ufi",
+    "latitude",
+    "longitude",
+    "country_code",
+    "subdivision_code",
+    "gns_fd",
+    "language_code",
+    "population",
+)
+CITYNAME_COLUMNS = ("seq", "lang", "name", "latitude", "longitude")
+
+# Population is matched by a city name within the tolerance (in degrees).
+POPULATION_TOLERANCE = 0.03
+
+Populations = dict[tuple[int, int], list[tuple[int, str, str, float, float, int]]]
+
+# Set in pool workers by _init_cities_worker().
+_populations: Populations = {}
+_columns: dict[str, int] = {}
+
+
+def _cell(lat: float, lng: float) -> tuple[int, int]:
+    return math.floor(lat / POPULATION_TOLERANCE), math.floor(
+        lng / POPULATION_TOLERANCE
+    )
+
+
+def load_populations(file_name: str) -> Populations:
+    """Put populations into a grid of POPULATION_TOLERANCE sized cells."""
+    grid: Populations = defaultdict(list)
+    with open(file_name, "r", encoding="utf-8") as csvfile:
+        for idx, row in enumerate(csv.DictReader(csvfile)):
+            if row["Population"]:
+                lat, lng = float(row["Latitude"]), float(row["Longitude"])
+                grid[_cell(lat, lng)].append(
+                    (
+                        idx,
+                        row["City"].lower(),
+                        row["Country"].upper(),
+                        lat,
+                        lng,
+                        int(row["Population"]),
+                    )
+                )
+
+    return dict(grid)
+
+
+def find_population(lat: float, lng: float, country_code: str, names: set[str]) -> int:
+    """The first population in the file that matches the location and a name."""
+    cell_lat, cell_lng = _cell(lat, lng)
+    matches = [
+        (idx, population)
+        for i in (-1, 0, 1)
+        for j in (-1, 0, 1)
+        for idx, name, country, p_lat, p_lng, population in _populations.get(
+            (cell_lat + i, cell_lng + j), ()
+        )
+        if name in names
+        and country == country_code
+        and abs(p_lat - lat) < POPULATION_TOLERANCE
+        and abs(p_lng - lng) < POPULATION_TOLERANCE
+    ]
+    return min(matches)[1] if matches else 0
+
+
+def _init_cities_worker(populations: Populations, columns: dict[str, int]) -> None:
+    # pylint: disable=global-statement
+    global _populations, _columns
+    _populations, _columns = populations, columns
+    # Connections of the parent process must not be used in the worker.
+    db.engine.dispose(close=False)
+
+
+def transform_cities(seq: int, lines: list[str]) -> tuple[list[tuple], list[tuple]]:
+    """
+    Parse a chunk of worldcities CSV lines.
+
+    Rows of the same location go one after another, the first of them
+    gives a City, every row gives a CityName.
+    """
+    cities, names = [], []
+    groups: dict[tuple[float, float], list[list[str]]] = {}
+    for row in csv.reader(lines):
+        location = (
+            float(row[_columns[" latitude"]]),
+            float(row[_columns[" longitude"]]),
+        )
+        groups.setdefault(location, []).append(row)
+
+    for (lat, lng), rows in groups.items():
+        row = rows[0]
+        country_code = row[_columns["ISO 3166-1 country code"]]
+        cities.append(
+            (
+                seq,
+                int(row[_columns[" GNS UFI"]] or 0),
+                lat,
+                lng,
+                country_code,
+                row[_columns[" FIPS 5-2 subdivision code"]],
+                row[_columns[" GNS FD"]],
+                row[_columns[" ISO 639-1 language code"]],
+                find_population(
+                    lat,
+                    lng,
+                    country_code.upper(),
+                    {r[_columns[" name"]].lower() for r in rows},
+                ),
+            )
+        )
+        for r in rows:
+            names.append(
+                (seq, r[_columns[" language script"]], r[_columns[" name"]], lat, lng)
+            )
+            seq += 1
+
+    return cities, names
+
+
+def read_chunks(
+    lines: Iterator[str], chunk_size: int, columns: dict[str, int]
+) -> Iterator[list[str]]:
+    """
+    Chunks of about chunk_size lines, rows of a location aren't split.
+
+    Every chunk gets all names of its locations, the population of a
+    location is matched by any of them (see transform_cities).
+    """
+
+    def location(line: str) -> tuple[float, float]:
+        row = next(csv.reader([line]))
+        return float(row[columns[" latitude"]]), float(row[columns[" longitude"]])
+
+    chunk = list(islice(lines, chunk_size))
+    while chunk:
+        last, next_line = location(chunk[-1]), None
+        for line in lines:
+            if location(line) != last:
+                next_line = line
+                break
+            chunk.append(line)
+        yield chunk
+
+        chunk = [] if next_line is None else [next_line]
+        chunk.extend(islice(lines, chunk_size - len(chunk)))
+
+
+def import_cities_file(  # pylint: disable=too-many-locals
+    conn: Connection,
+    file_name: str,
+    populations: Populations,
+    *,
+    rows: int | None = None,
+    workers: int | None = None,
+    chunk_size: int = 10000,
+    incremental: bool = False,
+    progress: ImportProgress | None = None,
+) -> tuple[int, int, int]:
+    """
+    Import cities with a single pass over the file.
+
+    Chunks of lines are parsed in a process pool (only a few chunks are in
+    flight to keep memory bounded) and copied to temporary tables, then cities
+    are deduplicated by location and names are linked to them in SQL.
+    An existing location fails the import like in the other append imports,
+    in incremental mode the city is updated if changed and only missing names
+    are added.
+    Return number of inserted cities, updated cities and inserted city names.
+    """
+    progress = progress or ImportProgress("import_cities")
+    conn.execute(
+        text(
+            "CREATE TEMP TABLE import_city ("
+            "seq bigint, gns_ufi integer, latitude float, longitude float, "
+            "country_code varchar(2), subdivision_code varchar(8), "
+            "gns_fd varchar(8), language_code varchar(16), population integer"
+            ") ON COMMIT DROP"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE TEMP TABLE import_cityname ("
+            "seq bigint, lang varchar(16), name varchar(128), "
+            "latitude float, longitude float"
+            ") ON COMMIT DROP"
+        )
+    )
+
+    workers = workers or os.cpu_count() or 1
+    with open(file_name, "r", encoding="utf-8") as csvfile:
+        header = next(csv.reader([next(csvfile)]))
+        columns = {name: i for i, name in enumerate(header)}
+        chunks = read_chunks(islice(csvfile, rows), chunk_size, columns)
+        with ProcessPoolExecutor(
+            workers,
+            initializer=_init_cities_worker,
+            initargs=(populations, columns),
+        ) as executor:
+            in_flight: deque[Future] = deque()
+            seq = 0
+            while True:
+                with progress.phase("read"):
+                    chunk = next(chunks, None)
+                if chunk:
+                    in_flight.append(executor.submit(transform_cities, seq, chunk))
+                    seq += len(chunk)
+                if in_flight and (not chunk or len(in_flight) >= workers * 2):
+                    with progress.phase("parse_transform"):
+                        cities, names = in_flight.popleft().result()
+                    with progress.phase("db_write"):
+                        copy_rows(conn, "import_city", CITY_COLUMNS, cities)
+                        copy_rows(conn, "import_cityname", CITYNAME_COLUMNS, names)
+                    progress.add(len(names))
+                elif not chunk:
+                    break
+
+    with progress.phase("merge"):
+        return _merge_cities(conn, incremental)
+
+
+def _merge_cities(conn: Connection, incremental: bool) -> tuple[int, int, int]:
+    """Move imported cities and names from temporary tables."""
+    # The first row of a location gives a City.
+    inserted = updated = 0
+    for (is_inserted,) in conn.execute(
+        text(
+            upsert_query(
+                "city",
+                "import_city",
+                CITY_COLUMNS[1:],
+                ("latitude", "longitude"),
+                constraint="location",
+                order_by="seq",
+                update=incremental,
+            )
+        )
+    ):
+        if is_inserted:
+            inserted += 1
+        else:
+            updated += 1
+
+    names_count = conn.execute(
+        text(
+            "INSERT INTO cityname (lang, name, city_id) "
+            "SELECT n.lang, n.name, c.id FROM import_cityname AS n "
+            "JOIN city AS c "
+            "ON c.latitude = n.latitude AND c.longitude = n.longitude "
+            + (
+                "WHERE NOT EXISTS (SELECT 1 FROM cityname AS e WHERE "
+                "e.city_id = c.id AND e.lang = n.lang AND e.name = n.name) "
+                if incremental
+                else ""
+            )
+            + "ORDER BY n.seq"
+        )
+    ).rowcount
+
+    return inserted, updated, names_count
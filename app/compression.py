@@ -0,0 +1,84 @@
+"""
+Compression of /ajax/ responses (brotli if installed, gzip otherwise).
+
+Bodies are compressed once, compressed variants of recent bodies are kept
+in an LRU cache by digest, so repeated (cached) results aren't compressed
+again on every request.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+from typing import Optional
+
+from flask import Response, request
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from app import app
+from app.cache import LRUCache
+from app.metrics import LOCAL_CACHE_ITEMS
+from app.timing import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+compressed_cache = LRUCache(app.config["COMPRESSION_CACHE_SIZE"])
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=app.config["BROTLI_QUALITY"])
+    return gzip.compress(body, app.config["GZIP_LEVEL"], mtime=0)
+
+
+def compress(body: bytes, accept_encoding: Accept) -> tuple[bytes, Optional[str]]:
+    """Compress the body with the best accepted encoding, if it's large enough."""
+    encoding = accept_encoding.best_match(ENCODINGS)
+    if encoding is None or len(body) < app.config["COMPRESSION_MIN_SIZE"]:
+        return body, None
+
+    key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+    compressed = compressed_cache.get(key)
+    if compressed is None:
+        compressed = _compress(body, encoding)
+        compressed_cache.set(key, compressed, app.config["COMPRESSION_CACHE_TTL"])
+        LOCAL_CACHE_ITEMS.labels("compressed").set(len(compressed_cache))
+    return compressed, encoding
+
+
+def compress_asgi(
+    body: bytes, headers: list[tuple[bytes, bytes]]
+) -> tuple[bytes, list[tuple[bytes, bytes]]]:
+    """Compress the body for ASGI request headers, return it with new headers."""
+    accept_encoding = dict(headers).get(b"accept-encoding", b"").decode("latin-1")
+    body, encoding = compress(body, parse_accept_header(accept_encoding))
+    response_headers = [(b"vary", b"Accept-Encoding")]
+    if encoding:
+        response_headers.append((b"content-encoding", encoding.encode()))
+    return body, response_headers
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    """Compress /ajax/ JSON responses."""
+    if (
+        not request.path.startswith("/ajax/")
+        or response.mimetype != "application/json"
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    with timed("compress"):
+        body, encoding = compress(response.get_data(), request.accept_encodings)
+    if encoding:
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,82 @@
+"""
+HTTP caching of /ajax/ lookups: ETag, Cache-Control and 304 responses.
+
+Results only change when import commands bump data versions, so the ETag of
+a lookup is derived from the versions of its data and the request
+parameters. Conditional requests are answered before the lookup runs, the
+versions are usually in memory of the worker (see DATA_VERSION_TTL).
+
+Stale results served under overload (see app.cache.shed_load) may predate
+the current versions and incomplete ones (see app.cache.Incomplete) lack
+data, they are sent without the ETag and aren't stored.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from typing import Optional
+
+from flask import Response, g, request
+from werkzeug.http import parse_etags
+
+from app import app
+from app.cache import format_key, get_data_versions
+from app.timing import current_timing
+
+# Results the cache layer didn't cache (see `note(cache=...)`).
+NOT_CACHED = ("stale", "incomplete")
+NOT_CACHED_CACHE_CONTROL = "no-store"
+
+
+def make_etag(namespace: str, versions: list[int], args: dict[str, str]) -> str:
+    """Weak ETag (compressed bodies are the same) of the lookup."""
+    key = format_key(namespace, versions, tuple(sorted(args.items())))
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def cache_control(namespace: str) -> str:
+    return f"public, max-age={app.config['HTTP_CACHE_MAX_AGE'][namespace]}"
+
+
+def is_cacheable() -> bool:
+    """The result of the current lookup can be kept by browsers and CDN."""
+    timing = current_timing()
+    return timing is None or timing.fields.get("cache") not in NOT_CACHED
+
+
+def is_not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    """The client has the current version (If-None-Match header matches)."""
+    return parse_etags(if_none_match).contains_weak(etag)
+
+
+@app.before_request
+def not_modified() -> Optional[Response]:
+    """Answer conditional requests of lookups with 304 if the data is the same."""
+    g.etag = None
+    namespace = request.endpoint
+    if request.method != "GET" or namespace not in app.config["HTTP_CACHE_MAX_AGE"]:
+        return None
+
+    versions = get_data_versions(app.config["CACHE_DEPENDENCIES"][namespace])
+    g.etag = make_etag(namespace, versions, request.args.to_dict())
+    if not is_not_modified(request.headers.get("If-None-Match"), g.etag):
+        return None
+
+    response = Response(status=304)
+    response.set_etag(g.etag, weak=True)
+    response.headers["Cache-Control"] = cache_control(namespace)
+    return response
+
+
+@app.after_request
+def add_validators(response: Response) -> Response:
+    """Send ETag and Cache-Control with successful lookups."""
+    if not g.get("etag") or response.status_code != 200:
+        return response
+
+    if is_cacheable():
+        response.set_etag(g.etag, weak=True)
+        response.headers["Cache-Control"] = cache_control(request.endpoint)
+    else:
+        response.headers["Cache-Control"] = NOT_CACHED_CACHE_CONTROL
+    return response
@@ -1,28 +1,115 @@
+from __future__ import annotations
+
+from contextlib import suppress
+from functools import lru_cache
+import json
 import os
+import pwd
+import stat
+import tempfile
+import time
+
 import requests
 
 SITE_ENV_PREFIX = "AIRTICKETS"
 
+METADATA_URL = "http://metadata.google.internal/computeMetadata/v1/instance/attributes/"
+# The metadata server is local, if it doesn't answer fast there is none.
+METADATA_TIMEOUT = 0.5
+# Metadata is shared by all workers of the host through a file in the cache
+# directory of the user running them. Gunicorn keeps $HOME of the master when
+# it switches the user, so the home directory is looked up by uid.
+METADATA_CACHE_DIR = os.environ.get(f"{SITE_ENV_PREFIX}_CACHE_DIR") or os.path.join(
+    pwd.getpwuid(os.getuid()).pw_dir, ".cache", "airtickets"
+)
+METADATA_CACHE_FILE = os.path.join(METADATA_CACHE_DIR, "metadata.json")
+METADATA_CACHE_TTL = 3600
+# Recheck sooner when there was no metadata server.
+METADATA_MISS_CACHE_TTL = 60
 
-def get_env_var(name: str, default: str = "") -> str:
-    """Get all sensitive data from google vm custom metadata."""
+
+def _read_metadata_cache() -> dict[str, str] | None:
+    """Metadata cached by another process of this host if it's still fresh."""
     try:
-        name = f"{SITE_ENV_PREFIX}_{name}"
-        res = os.environ.get(name)
-        if res:
-            # Check env variable (Jenkins build).
-            return res
+        fd = os.open(METADATA_CACHE_FILE, os.O_RDONLY | os.O_NOFOLLOW)
+        with os.fdopen(fd, encoding="utf-8") as f:
+            file_stat = os.fstat(fd)
+            # Trust only a file written by _write_metadata_cache of this user.
+            if (
+                file_stat.st_uid != os.getuid()
+                or stat.S_IMODE(file_stat.st_mode) != 0o600
+            ):
+                return None
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
 
+    attributes = cached.get("attributes")
+    ttl = METADATA_CACHE_TTL if cached.get("found") else METADATA_MISS_CACHE_TTL
+    if not isinstance(attributes, dict) or time.time() - file_stat.st_mtime > ttl:
+        return None
+    return attributes
+
+
+def _write_metadata_cache(attributes: dict[str, str], found: bool) -> None:
+    """Atomically share metadata with other processes, readable only by us."""
+    try:
+        os.makedirs(METADATA_CACHE_DIR, mode=0o700, exist_ok=True)
+        # Created with 0600 mode.
+        fd, tmp_file = tempfile.mkstemp(dir=METADATA_CACHE_DIR, suffix=".tmp")
+    except OSError:
+        return
+
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"found": found, "attributes": attributes}, f)
+        os.replace(tmp_file, METADATA_CACHE_FILE)
+    except OSError:
+        with suppress(OSError):
+            os.unlink(tmp_file)
+
+
+@lru_cache(maxsize=None)
+def get_metadata() -> dict[str, str]:
+    """All google vm custom metadata, fetched with a single request per host."""
+    attributes = _read_metadata_cache()
+    if attributes is not None:
+        return attributes
+
+    try:
         res = requests.get(
-            "http://metadata.google.internal/computeMetadata/"
-            f"v1/instance/attributes/{name}",
+            METADATA_URL,
+            params={"recursive": "true"},
             headers={"Metadata-Flavor": "Google"},
+            timeout=METADATA_TIMEOUT,
         )
-        if res.status_code == 200:
-            return res.text
-    except requests.exceptions.ConnectionError:
-        return default
-    return default
+        if res.status_code != 200:
+            # Not cached, the server is there but unhealthy.
+            return {}
+        attributes = res.json()
+        found = True
+    except requests.exceptions.Timeout:
+        # Not cached, the server may be just slow.
+        return {}
+    except requests.exceptions.RequestException:
+        # There is no server (e.g. the name isn't resolved).
+        attributes, found = {}, False
+    except ValueError:
+        return {}
+
+    _write_metadata_cache(attributes, found)
+    return attributes
+
+
+def get_env_var(name: str, default: str = "") -> str:
+    """Get all sensitive data from google vm custom metadata."""
+    name = f"{SITE_ENV_PREFIX}_{name}"
+    res = os.environ.get(name)
+    if res:
+        # Check env variable (Jenkins build).
+        return res
+
+    return get_metadata().get(name, default)
 
 
 class DefaultConfig:
@@ -33,7 +120,144 @@ class DefaultConfig:
         f"@{get_env_var('DB_HOST', '127.0.0.1')}/{get_env_var('DB_NAME', 'airtickets')}"
     )
 
+    # Read-only view queries go to these, the primary is used when all of
+    # them are down.
+    SQLALCHEMY_REPLICA_URIS = [
+        "postgresql://"
+        f"{get_env_var('DB_USER', 'airtickets')}:{get_env_var('DB_PASSWORD', 'airtickets')}"
+        f"@{host}/{get_env_var('DB_NAME', 'airtickets')}"
+        for host in get_env_var("DB_REPLICA_HOSTS").split(",")
+        if host
+    ]
+    # Skip a replica after N failed connections, probe it with backoff (seconds).
+    DB_REPLICA_FAILURE_THRESHOLD = 1
+    DB_REPLICA_BACKOFF = 5
+    DB_REPLICA_MAX_BACKOFF = 60
+    # Seconds replicas may lag behind the primary, reads use the primary for
+    # this long after an import so new data versions don't cache old rows.
+    REPLICA_MAX_LAG = 30
+
+    # One pool per worker process, shared by the ORM and raw queries. Every
+    # request thread (threads in gunicorn.conf.py) and FANOUT_WORKERS lookup
+    # may hold a connection, plus the serving store loader and EXPLAIN of slow
+    # queries. Requests waiting for a connection longer are answered with 503.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": 8,
+        "max_overflow": 10,
+        # Seconds to wait for a free connection.
+        "pool_timeout": 5,
+        # Replace connections dropped by the server or a proxy.
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    # Cancel raw queries running longer than this (in milliseconds).
+    STATEMENT_TIMEOUT = {
+        "closest_airports": 2000,
+        "closest_cities": 2000,
+        "route_path": 5000,
+    }
+
+    # Threads per worker running backend lookups concurrently with the request,
+    # one per request thread (threads in gunicorn.conf.py) so they don't queue.
+    FANOUT_WORKERS = 8
+    # Seconds /ajax/airports waits for the closest city (ES or SQL) lookup, it's
+    # answered without the city (not cached) after that.
+    CLOSEST_CITY_TIMEOUT = 2
+
     REDIS_URL = "redis://:@localhost:6379/5"
+    # Fail fast when Redis is unreachable, the cache is optional.
+    REDIS_SOCKET_TIMEOUT = 0.25
+    REDIS_SOCKET_CONNECT_TIMEOUT = 0.25
+    # Skip Redis after N consecutive failures, probe it with backoff (seconds).
+    REDIS_CIRCUIT_FAILURE_THRESHOLD = 3
+    REDIS_CIRCUIT_BACKOFF = 5
+    REDIS_CIRCUIT_MAX_BACKOFF = 60
+
+    # Bump to invalidate all cached values (e.g. when their format changes).
+    CACHE_KEY_VERSION = 3
+
+    # Data every cached namespace depends on. Import commands bump version of
+    # the imported data, so keys of dependent namespaces change.
+    CACHE_DEPENDENCIES = {
+        "autocomplete_cities": ("cities",),
+        "airports": ("airports", "cities"),
+        "routes": ("routes", "airports"),
+        "get_cities": ("cities",),
+    }
+    # How long workers use their copy of data versions (in seconds).
+    DATA_VERSION_TTL = 5
+
+    # Redis cache TTL per namespace (in seconds).
+    CACHE_TTL = {
+        "autocomplete_cities": 86400,
+        "airports": 86400,
+        "routes": 86400,
+        "get_cities": 86400,
+    }
+
+    # Expire keys up to 10% earlier so they don't expire all at once.
+    CACHE_TTL_JITTER = 0.1
+    # Only one worker computes a missed key, others wait up to CACHE_LOCK_WAIT
+    # seconds for the result. The lock expires after CACHE_LOCK_TIMEOUT seconds.
+    CACHE_LOCK_TIMEOUT = 30
+    CACHE_LOCK_WAIT = 3
+
+    # Concurrent computations of missed keys (cache hits aren't limited) and
+    # computations waiting for a slot, per namespace of a worker. The rest
+    # wait up to ADMISSION_WAIT seconds, then the last computed value (see
+    # CACHE_STALE_TTL) is served or 503 if there is none.
+    ADMISSION_LIMITS = {
+        "autocomplete_cities": (4, 8),
+        "airports": (4, 8),
+        "routes": (2, 4),
+        "get_cities": (4, 8),
+    }
+    ADMISSION_WAIT = 2
+    # Namespaces keeping the last computed value of every key for overload,
+    # for how long (in seconds). The copy outlives data versions of the key,
+    # so it doubles Redis memory of the namespace.
+    CACHE_STALE_TTL = {"routes": 7 * 86400}
+
+    # Log a JSON line with the Server-Timing breakdown of every /ajax/ request.
+    SERVER_TIMING_LOG = False
+
+    # Queries slower than SLOW_QUERY_THRESHOLD ms are saved to Redis (the last
+    # SLOW_QUERY_LOG_SIZE of them), this share of them with EXPLAIN ANALYZE.
+    SLOW_QUERY_THRESHOLD = 500
+    SLOW_QUERY_LOG_SIZE = 1000
+    SLOW_QUERY_EXPLAIN_RATE = 0.1
+    SLOW_QUERY_EXPLAIN_TIMEOUT = 10000
+
+    # Browsers and CDN keep /ajax/ lookups for max-age seconds, then revalidate
+    # them with the ETag (it changes when the data version changes).
+    HTTP_CACHE_MAX_AGE = {
+        "autocomplete_cities": 3600,
+        "airports": 600,
+        "routes": 600,
+        "get_cities": 600,
+    }
+
+    # Compress /ajax/ responses of at least COMPRESSION_MIN_SIZE bytes, with
+    # brotli if it's installed. Compressed bodies are cached by the worker.
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_CACHE_SIZE = 256
+    COMPRESSION_CACHE_TTL = 300
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 5
+
+    # Serve cities and airports lookups from memory of the worker (app.serving)
+    # instead of PostgreSQL. Every worker loads all cities at start and when
+    # the data changes, raise max_requests (gunicorn.conf.py) if it's enabled.
+    SERVING_STORE = False
+
+    # Per-worker in-memory LRU cache in front of Redis.
+    LOCAL_CACHE_MAX_SIZE = 2048
+    LOCAL_CACHE_TTL = {
+        "autocomplete_cities": 600,
+        "airports": 300,
+        "routes": 300,
+        "get_cities": 300,
+    }
 
     # the toolbar is only enabled in debug mode:
     DEBUG = False
@@ -56,4 +280,9 @@ class TestConfig(DefaultConfig):
         f"@{get_env_var('DB_HOST', '127.0.0.1')}/{get_env_var('TEST_DB_NAME', 'test_airtickets')}"
     )
 
+    SQLALCHEMY_REPLICA_URIS: list[str] = []
+
+    # Tests change the data without bumping data versions.
+    SERVING_STORE = False
+
     REDIS_URL = "redis://:@localhost:6379/6"
@@ -0,0 +1,281 @@
+"""
+Bulk loading of CSV data into PostgreSQL with COPY.
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+import csv
+import io
+from typing import Any, Iterable, Iterator, Sequence
+
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import text
+
+from app.models import Airport, get_distance
+
+AIRLINE_COLUMNS = (
+    "source_id",
+    "name",
+    "alias",
+    "iata",
+    "icao",
+    "callsign",
+    "country",
+    "active",
+)
+# Columns of the data feed, the id comes from its own sequence.
+AIRPORT_COLUMNS = ("source_id", *Airport.API_COLUMNS[1:])
+ROUTE_COLUMNS = (
+    "source",
+    "destination",
+    "airline",
+    "distance",
+    "codeshare",
+    "equipment",
+)
+
+# Natural keys of imported rows.
+AIRLINE_KEY = ("source_id",)
+AIRPORT_KEY = ("source_id",)
+ROUTE_KEY = ("source", "destination", "airline")
+
+
+class CsvStream(io.RawIOBase):
+    """File-like object that serializes rows to UTF-8 CSV while COPY reads it."""
+
+    def __init__(self, rows: Iterable[Sequence[Any]]) -> None:
+        super().__init__()
+        self.count = 0
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        # Strings are quoted, so empty strings stay empty strings and
+        # None (an unquoted empty value) becomes NULL.
+        self._writer = csv.writer(
+            self._buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n"
+        )
+        self._data = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._data) < size:
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                break
+
+            self._writer.writerow(row)
+            self.count += 1
+            if self._buffer.tell() > 65536:
+                self._flush()
+
+        self._flush()
+        if size < 0:
+            size = len(self._data)
+        chunk, self._data = self._data[:size], self._data[size:]
+        return chunk
+
+    def _flush(self) -> None:
+        self._data += self._buffer.getvalue().encode("utf-8")
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+
+def copy_rows(
+    conn: Connection, table: str, columns: Sequence[str], rows: Iterable[Sequence]
+) -> int:
+    """Stream rows into the table with COPY FROM STDIN, return number of rows."""
+    stream = CsvStream(rows)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) "
+            "FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8')",
+            stream,
+        )
+
+    return stream.count
+
+
+def upsert_rows(
+    conn: Connection,
+    table: str,
+    columns: Sequence[str],
+    key: Sequence[str],
+    rows: Iterable[Sequence],
+) -> tuple[int, int]:
+    """
+    Insert new rows and update changed ones.
+
+    Rows are copied to a temporary table, then inserted with
+    INSERT ... ON CONFLICT on the natural key, existing rows are updated only
+    if their checksum differs. Return number of inserted and updated rows.
+    """
+    staging = f"import_{table}"
+    conn.execute(
+        text(
+            f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+            f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA"
+        )
+    )
+    copy_rows(conn, staging, columns, rows)
+
+    inserted = updated = 0
+    for (is_inserted,) in conn.execute(
+        text(upsert_query(table, staging, columns, key))
+    ):
+        if is_inserted:
+            inserted += 1
+        else:
+            updated += 1
+
+    return inserted, updated
+
+
+def load_rows(
+    conn: Connection,
+    table: str,
+    columns: Sequence[str],
+    key: Sequence[str],
+    rows: Iterable[Sequence],
+    *,
+    incremental: bool = False,
+) -> tuple[int, int]:
+    """Append rows or upsert them in incremental mode, see upsert_rows()."""
+    if incremental:
+        return upsert_rows(conn, table, columns, key, rows)
+
+    return copy_rows(conn, table, columns, rows), 0
+
+
+def upsert_query(
+    table: str,
+    staging: str,
+    columns: Sequence[str],
+    key: Sequence[str],
+    *,
+    constraint: str | None = None,
+    order_by: str | None = None,
+    update: bool = True,
+) -> str:
+    """
+    Insert the first staging row of every key, update changed existing rows.
+
+    Without update it's an append: an existing key violates the constraint,
+    like rows appended with COPY do.
+    """
+    columns_list = ", ".join(columns)
+    key_list = ", ".join(key)
+    conflict = ""
+    if update:
+        target = f"ON CONSTRAINT {constraint}" if constraint else f"({key_list})"
+        assignments = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns)
+        conflict = (
+            f"ON CONFLICT {target} DO UPDATE SET {assignments}, "
+            "checksum = EXCLUDED.checksum "
+            f"WHERE {table}.checksum IS DISTINCT FROM EXCLUDED.checksum "
+        )
+    # A row can't be affected twice by one INSERT, so the first row of a key wins.
+    return (
+        f"INSERT INTO {table} ({columns_list}, checksum) "
+        f"SELECT {columns_list}, md5(ROW({columns_list})::text) FROM ("
+        f"SELECT DISTINCT ON ({key_list}) * FROM {staging} "
+        f"ORDER BY {key_list}{', ' + order_by if order_by else ''}"
+        f") AS staging{' ORDER BY ' + order_by if order_by else ''} "
+        + conflict
+        + "RETURNING xmax = 0"
+    )
+
+
+def airline_row(row: dict[str, str]) -> tuple:
+    """Airline CSV row to AIRLINE_COLUMNS values."""
+    return (
+        int(row["Airline ID"]),
+        row["Name"],
+        row["Alias"],
+        row["IATA"],
+        row["ICAO"],
+        row["Callsign"],
+        row["Country"],
+        row["Active"] == "Y",
+    )
+
+
+def airport_row(row: dict[str, str]) -> tuple:
+    """Airport CSV row to AIRPORT_COLUMNS values."""
+    return (
+        int(row["Airport ID"]),
+        row["Name"],
+        row["City"],
+        row["Country"],
+        row["IATA/FAA"],
+        row["ICAO"],
+        float(row["Latitude"]),
+        float(row["Longitude"]),
+        float(row["Timezone"]),
+        row["DST"],
+        row["Tz database time zone"],
+    )
+
+
+def get_airlines_map(conn: Connection) -> dict[str, int]:
+    """Airline IATA code to id."""
+    return dict(
+        conn.execute(
+            text(
+                "SELECT DISTINCT ON (iata) iata, id FROM airline "
+                "WHERE iata <> '' ORDER BY iata, id"
+            )
+        ).all()
+    )
+
+
+def get_airports_map(conn: Connection) -> dict[str, tuple[int, float, float]]:
+    """Airport IATA/FAA code to (id, latitude, longitude)."""
+    return {
+        row.iata_faa: (row.id, row.latitude, row.longitude)
+        for row in conn.execute(
+            text(
+                "SELECT DISTINCT ON (iata_faa) iata_faa, id, latitude, longitude "
+                "FROM airport WHERE iata_faa <> '' ORDER BY iata_faa, id"
+            )
+        )
+    }
+
+
+def route_rows(
+    rows: Iterable[dict[str, str]],
+    airlines: dict[str, int],
+    airports: dict[str, tuple[int, float, float]],
+    rejected: Counter,
+) -> Iterator[tuple]:
+    """Route CSV rows to ROUTE_COLUMNS values, count rejected rows by reason."""
+    for row in rows:
+        if not all([row["Source airport"], row["Destination airport"], row["Airline"]]):
+            rejected["incorrect row"] += 1
+            continue
+
+        airline_id = airlines.get(row["Airline"])
+        if not airline_id:
+            rejected["no airline"] += 1
+            continue
+
+        source = airports.get(row["Source airport"])
+        if not source:
+            rejected["no source_airport"] += 1
+            continue
+
+        destination = airports.get(row["Destination airport"])
+        if not destination:
+            rejected["no destination_airport"] += 1
+            continue
+
+        yield (
+            source[0],
+            destination[0],
+            airline_id,
+            get_distance(source[1], source[2], destination[1], destination[2]),
+            row["Codeshare"] == "Y",
+            row["Equipment"],
+        )
@@ -0,0 +1,196 @@
+"""
+Load test replaying /ajax requests from a log or a synthetic workload.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import itertools
+import random
+import re
+import threading
+from time import perf_counter, sleep
+from typing import Any, Callable, Iterable, Iterator, Optional
+from urllib.parse import urlencode, urlsplit
+
+import requests
+
+from app import app
+
+# Share of each endpoint in the synthetic workload.
+WORKLOAD_MIX = {
+    "autocomplete_cities": 0.4,
+    "airports": 0.3,
+    "get_cities": 0.2,
+    "routes": 0.1,
+}
+
+_AJAX_PATH = re.compile(r"(/ajax/[^\s\"]+)")
+
+
+def read_log(lines: Iterable[str]) -> Iterator[str]:
+    """/ajax URLs of a request log (one URL per line or an access log)."""
+    for line in lines:
+        match = _AJAX_PATH.search(line)
+        if match:
+            yield match.group(1)
+
+
+def _airport_url(endpoint: str, airport: dict[str, str], rnd: random.Random) -> str:
+    """URL of a lookup about the airport (a row of the airports file)."""
+    lat, lng = float(airport["Latitude"]), float(airport["Longitude"])
+    if endpoint == "autocomplete_cities":
+        query = airport["City"][: rnd.randint(2, 4)]
+        return "/ajax/autocomplete/cities?" + urlencode({"query": query})
+    if endpoint == "airports":
+        params = {"lat": lat, "lng": lng, "limit": 5, "find_closest_city": "true"}
+        return "/ajax/airports?" + urlencode(params)
+    params = {
+        "ne_lng": round(lng + 1, 2),
+        "ne_lat": round(lat + 1, 2),
+        "sw_lng": round(lng - 1, 2),
+        "sw_lat": round(lat - 1, 2),
+    }
+    return "/ajax/get-cities?" + urlencode(params)
+
+
+def _routes_url(
+    airport_ids: dict[str, int], source: dict[str, str], destination: dict[str, str]
+) -> str:
+    params = {
+        "from_airport": airport_ids[source["IATA/FAA"]],
+        "to_airport": airport_ids[destination["IATA/FAA"]],
+    }
+    return "/ajax/routes?" + urlencode(params)
+
+
+def synthetic_workload(
+    airports_file: str,
+    airport_ids: dict[str, int],
+    count: int,
+    zipf: float = 1.1,
+    seed: int = 0,
+) -> list[str]:
+    """
+    URLs of `count` requests about airports of Zipfian popularity.
+
+    `airport_ids` maps IATA/FAA codes to ids of the airports in the database,
+    routes are only requested between airports found there.
+    """
+    rnd = random.Random(seed)
+    with open(airports_file, "r", encoding="utf-8") as csvfile:
+        airports = [
+            row for row in csv.DictReader(csvfile) if row["Latitude"] and row["City"]
+        ]
+    rnd.shuffle(airports)
+    popularity = list(
+        itertools.accumulate(1 / rank**zipf for rank in range(1, len(airports) + 1))
+    )
+    routable = [a for a in airports if a["IATA/FAA"] in airport_ids]
+    route_popularity = popularity[: len(routable)]
+
+    mix = dict(WORKLOAD_MIX)
+    if len(routable) < 2:
+        del mix["routes"]
+
+    urls = []
+    for endpoint in rnd.choices(list(mix), list(mix.values()), k=count):
+        airport = rnd.choices(airports, cum_weights=popularity)[0]
+        if endpoint == "routes":
+            urls.append(
+                _routes_url(
+                    airport_ids,
+                    *rnd.choices(routable, cum_weights=route_popularity, k=2),
+                )
+            )
+        else:
+            urls.append(_airport_url(endpoint, airport, rnd))
+
+    return urls
+
+
+def client_sender() -> Callable[[str], int]:
+    """Send requests to the app in this process, a test client per thread."""
+    local = threading.local()
+
+    def send(url: str) -> int:
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        return local.client.get(url).status_code
+
+    return send
+
+
+def http_sender(base_url: str, timeout: float = 30) -> Callable[[str], int]:
+    """Send requests to a running server, 0 status means no response."""
+    local = threading.local()
+
+    def send(url: str) -> int:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        try:
+            return local.session.get(base_url + url, timeout=timeout).status_code
+        except requests.RequestException:
+            return 0
+
+    return send
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    return round(samples[min(len(samples) - 1, int(len(samples) * q))], 2)
+
+
+def _stats(results: list[tuple[int, float]], duration: float) -> dict[str, Any]:
+    latencies = sorted(latency for _, latency in results)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for status, _ in results if not 200 <= status < 400),
+        "throughput": round(len(results) / duration, 2),
+        "p50_ms": _percentile(latencies, 0.5),
+        "p95_ms": _percentile(latencies, 0.95),
+        "p99_ms": _percentile(latencies, 0.99),
+    }
+
+
+def run_load(
+    urls: list[str],
+    send: Callable[[str], int],
+    rate: Optional[float],
+    concurrency: int,
+) -> dict[str, Any]:
+    """
+    Send requests at `rate` per second (as fast as possible without it).
+
+    Latency is counted from the time a request was due, so requests queued
+    behind slow ones are slow too.
+    """
+    results: dict[str, list[tuple[int, float]]] = {}
+    lock = threading.Lock()
+    start = perf_counter()
+
+    def request(i: int, url: str) -> None:
+        due = start + i / rate if rate else perf_counter()
+        delay = due - perf_counter()
+        if delay > 0:
+            sleep(delay)
+        status = send(url)
+        latency = (perf_counter() - due) * 1000
+        with lock:
+            results.setdefault(urlsplit(url).path, []).append((status, latency))
+
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="loadtest") as executor:
+        for future in [executor.submit(request, i, url) for i, url in enumerate(urls)]:
+            future.result()
+    duration = perf_counter() - start
+
+    report = {
+        "duration_s": round(duration, 2),
+        "endpoints": {
+            path: _stats(endpoint_results, duration)
+            for path, endpoint_results in sorted(results.items())
+        },
+    }
+    if results:
+        report["total"] = _stats(list(itertools.chain(*results.values())), duration)
+    return report
@@ -0,0 +1,100 @@
+"""
+Prometheus metrics of the app, served on /metrics.
+
+With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py
+does it), every worker writes its metrics there and /metrics aggregates them.
+"""
+
+from __future__ import annotations
+
+import os
+from time import perf_counter
+
+from flask import Response, g, request
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from app import app, db
+
+REQUEST_LATENCY = Histogram(
+    "airtickets_request_duration_seconds",
+    "Request latency by endpoint.",
+    ["endpoint"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUESTS = Counter(
+    "airtickets_requests_total",
+    "Requests by endpoint and status.",
+    ["endpoint", "status"],
+)
+CACHE_REQUESTS = Counter(
+    "airtickets_cache_requests_total",
+    "Cache lookups by namespace and result (hit, miss or error).",
+    ["namespace", "result"],
+)
+CACHE_MISS_DURATION = Histogram(
+    "airtickets_cache_miss_duration_seconds",
+    "Time to compute a missed cache value by namespace.",
+    ["namespace"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+CACHE_PAYLOAD_BYTES = Histogram(
+    "airtickets_cache_payload_bytes",
+    "Size of pickled values cached by namespace.",
+    ["namespace"],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+)
+BACKEND_FALLBACKS = Counter(
+    "airtickets_backend_fallbacks_total",
+    "Lookups answered by PostgreSQL because Elasticsearch was unavailable.",
+    ["lookup"],
+)
+LOAD_SHED = Counter(
+    "airtickets_load_shed_total",
+    "Computations rejected by admission control, answered stale or with 503.",
+    ["namespace", "outcome"],
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "airtickets_db_pool_connections",
+    "Connections of the primary database pool by state.",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+LOCAL_CACHE_ITEMS = Gauge(
+    "airtickets_local_cache_items",
+    "Items in the in-memory caches of the workers.",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+
+
+def render() -> bytes:
+    """Metrics of all workers in the text exposition format."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+@app.after_request
+def observe_request(response: Response) -> Response:
+    """Record latency of the request and utilization of the pool."""
+    endpoint = request.endpoint or "unknown"
+    REQUEST_LATENCY.labels(endpoint).observe(
+        perf_counter() - g.get("request_start", perf_counter())
+    )
+    REQUESTS.labels(endpoint, response.status_code).inc()
+
+    pool = db.engine.pool
+    DB_POOL_CONNECTIONS.labels("checked_out").set(pool.checkedout())
+    DB_POOL_CONNECTIONS.labels("idle").set(pool.checkedin())
+    return response
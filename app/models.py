@@ -5,10 +5,18 @@ from functools import reduce
 import math
 from typing import Any
 
+from sqlalchemy import Select, select
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import DBAPIError, OperationalError
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import contains_eager, joinedload
 from sqlalchemy.sql import text
+from sqlalchemy.sql.elements import TextClause
 
-from app import app, db, engine
+from app import app, db
+from app.replicas import read_connection, read_session
+from app.slow_queries import QUERY_CANCELED
+from app.timing import add_rows, timed
 
 
 def _deg2rad(deg: float) -> float:
@@ -30,6 +38,34 @@ def get_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return distance
 
 
+# Local to the transaction, the pooled connection keeps its default.
+SET_STATEMENT_TIMEOUT = text("SELECT set_config('statement_timeout', :timeout, true)")
+
+
+class QueryTimeout(Exception):
+    """A query was cancelled, because it ran longer than its statement timeout."""
+
+
+def is_query_canceled(e: DBAPIError) -> bool:
+    """The query was cancelled by statement_timeout (psycopg2 or asyncpg)."""
+    return getattr(e.orig, "pgcode", None) == QUERY_CANCELED
+
+
+def execute_raw(query: str, statement: TextClause, params: dict) -> list[Row]:
+    """Run a read-only raw query with its statement timeout, on a replica."""
+    timeout = app.config["STATEMENT_TIMEOUT"][query]
+    with read_connection() as conn, timed("sql"):
+        conn.execute(SET_STATEMENT_TIMEOUT, {"timeout": str(timeout)})
+        try:
+            rows = conn.execute(statement, params).fetchall()
+            add_rows(len(rows))
+            return rows
+        except OperationalError as e:
+            if is_query_canceled(e):
+                raise QueryTimeout(f"{query} query exceeded {timeout} ms") from e
+            raise
+
+
 class BaseModel(db.Model):
     __abstract__ = True
 
@@ -63,6 +99,8 @@ class BaseModel(db.Model):
 
 
 class Airport(BaseModel):
+    source_id = db.Column(db.Integer, unique=True)  # Airport ID in the data feed
+    checksum = db.Column(db.String(32))
     airport_name = db.Column(db.String(128))
     city = db.Column(db.String(128))
     country = db.Column(db.String(64))
@@ -74,14 +112,27 @@ class Airport(BaseModel):
     dst = db.Column(db.String(1))
     tz_database_time_zone = db.Column(db.String())
 
+    # Columns of airports in /ajax/airports (not the import bookkeeping).
+    API_COLUMNS = (
+        "id",
+        "airport_name",
+        "city",
+        "country",
+        "iata_faa",
+        "icao",
+        "latitude",
+        "longitude",
+        "timezone",
+        "dst",
+        "tz_database_time_zone",
+    )
+
     @staticmethod
-    def get_closest_airports(
+    def closest_airports_query(
         lat: float, lng: float, limit: int = 1, offset: int = 0
-    ) -> list[dict]:
-        conn = engine.connect()
-
+    ) -> tuple[TextClause, dict]:
         s = text(
-            "SELECT *, "
+            f"SELECT {', '.join(Airport.API_COLUMNS)}, "
             "("
             "3959 * acos( cos( radians(:latitude) ) * "
             "cos( radians( latitude ) ) * cos( radians( longitude ) - "
@@ -93,16 +144,25 @@ class Airport(BaseModel):
             "LIMIT :limit OFFSET :offset"
         )
 
-        raw_data = conn.execute(
-            s, dict(latitude=lat, longitude=lng, limit=limit, offset=offset)
-        ).fetchall()
+        return s, dict(latitude=lat, longitude=lng, limit=limit, offset=offset)
 
-        conn.close()
+    @staticmethod
+    def get_closest_airports(
+        lat: float, lng: float, limit: int = 1, offset: int = 0
+    ) -> list[dict]:
+        raw_data = execute_raw(
+            "closest_airports", *Airport.closest_airports_query(lat, lng, limit, offset)
+        )
 
         return [row._asdict() for row in raw_data]
 
 
 class Route(BaseModel):
+    __table_args__ = (
+        db.UniqueConstraint("source", "destination", "airline", name="route_key"),
+    )
+
+    checksum = db.Column(db.String(32))
     source = db.Column(db.Integer, db.ForeignKey("airport.id"))
     destination = db.Column(db.Integer, db.ForeignKey("airport.id"))
     airline = db.Column(db.Integer, db.ForeignKey("airline.id"))
@@ -111,10 +171,8 @@ class Route(BaseModel):
     equipment = db.Column(db.String)
 
     @staticmethod
-    def get_path(source: int, destination: int) -> dict[int, list]:
-        result = defaultdict(list)
-        s = text(
-            """
+    def path_query(source: int, destination: int) -> tuple[TextClause, dict]:
+        s = text("""
         WITH RECURSIVE search_graph(
             source, -- point 1
             destination, -- point 2
@@ -148,49 +206,69 @@ class Route(BaseModel):
         WHERE destination = :destination
         ORDER BY distance
         LIMIT 10
-        """
-        )
+        """)
 
-        conn = engine.connect()
-        raw_data = conn.execute(
-            s, dict(source=source, destination=destination)
-        ).fetchall()
-        conn.close()
-
-        needed_cities = list(reduce(lambda a, b: a | set(b["path"]), raw_data, set()))
-        airports = (
-            Airport.query.with_entities(
-                Airport.id,
-                Airport.airport_name,
-                Airport.latitude,
-                Airport.longitude,
+        return s, dict(source=source, destination=destination)
+
+    @staticmethod
+    def path_airports_query(raw_data: list[Row]) -> Select:
+        needed_cities = list(reduce(lambda a, b: a | set(b.path), raw_data, set()))
+        return select(
+            Airport.id,
+            Airport.airport_name,
+            Airport.latitude,
+            Airport.longitude,
+        ).filter(Airport.id.in_(needed_cities))
+
+    @staticmethod
+    def group_paths(raw_data: list[Row], airports: list[Row]) -> dict[str, dict]:
+        """Paths (airport ids) by number of flights and airports of the paths."""
+        result = defaultdict(list)
+        for row in raw_data:
+            result[row.depth].append(
+                {"nodes": list(row.path), "total_distance": row.distance}
             )
-            .filter(Airport.id.in_(needed_cities))
-            .all()
-        )
-        airports = {
-            airport.id: {
-                "airport_name": airport.airport_name,
-                "latitude": airport.latitude,
-                "longitude": airport.longitude,
-            }
-            for airport in airports
+
+        return {
+            "routes": result,
+            "airports": {
+                airport.id: {
+                    "airport_name": airport.airport_name,
+                    "latitude": airport.latitude,
+                    "longitude": airport.longitude,
+                }
+                for airport in airports
+            },
         }
 
-        for row in raw_data:
-            result[row["depth"]].append(
+    @staticmethod
+    def denormalize_paths(paths: dict[str, dict]) -> dict[int, list]:
+        """Paths with airports instead of their ids, the default routes format."""
+        airports = paths["airports"]
+        return {
+            depth: [
                 {
-                    "nodes": [airports[airport_id] for airport_id in row["path"]],
-                    "total_distance": row["distance"],
+                    "nodes": [airports[airport_id] for airport_id in path["nodes"]],
+                    "total_distance": path["total_distance"],
                 }
-            )
+                for path in depth_paths
+            ]
+            for depth, depth_paths in paths["routes"].items()
+        }
 
-        return result
+    @staticmethod
+    def get_path(source: int, destination: int) -> dict[str, dict]:
+        raw_data = execute_raw("route_path", *Route.path_query(source, destination))
+        with read_session() as session, timed("sql"):
+            airports = session.execute(Route.path_airports_query(raw_data)).all()
+
+        return Route.group_paths(raw_data, airports)
 
 
 class City(BaseModel):
     __table_args__ = (db.UniqueConstraint("latitude", "longitude", name="location"),)
 
+    checksum = db.Column(db.String(32))
     country_code = db.Column(db.String(2))
     subdivision_code = db.Column(db.String(8))
     gns_fd = db.Column(db.String(8))
@@ -203,13 +281,9 @@ class City(BaseModel):
     city_names = db.relationship("CityName", backref=db.backref("city_names"))
 
     @staticmethod
-    def get_closest_cities(
+    def closest_cities_query(
         lat: float, lng: float, limit: int = 1, offset: int = 0
-    ) -> list[dict]:
-        """Get the closest cities by coordinates."""
-        result = []
-        conn = engine.connect()
-
+    ) -> tuple[TextClause, dict]:
         s = text(
             "SELECT *, "
             "("
@@ -224,10 +298,11 @@ class City(BaseModel):
             "LIMIT :limit OFFSET :offset"
         )
 
-        raw_data = conn.execute(
-            s, dict(latitude=lat, longitude=lng, limit=limit, offset=offset)
-        )
+        return s, dict(latitude=lat, longitude=lng, limit=limit, offset=offset)
 
+    @staticmethod
+    def closest_cities_serialize(raw_data: list[Row]) -> list[dict]:
+        result = []
         for raw_item in raw_data:
             item = {
                 "id": raw_item.id,
@@ -239,10 +314,35 @@ class City(BaseModel):
             }
             result.append(item)
 
-        conn.close()
-
         return result
 
+    @staticmethod
+    def in_area_query(
+        ne_lng: float, ne_lat: float, sw_lng: float, sw_lat: float
+    ) -> Select:
+        """The most populated cities in the area, with their names."""
+        return (
+            select(City)
+            .options(joinedload(City.city_names))
+            .filter(City.longitude < ne_lng)
+            .filter(City.latitude < ne_lat)
+            .filter(City.longitude > sw_lng)
+            .filter(City.latitude > sw_lat)
+            .order_by(City.population.desc())
+            .limit(10)
+        )
+
+    @staticmethod
+    def get_closest_cities(
+        lat: float, lng: float, limit: int = 1, offset: int = 0
+    ) -> list[dict]:
+        """Get the closest cities by coordinates."""
+        raw_data = execute_raw(
+            "closest_cities", *City.closest_cities_query(lat, lng, limit, offset)
+        )
+
+        return City.closest_cities_serialize(raw_data)
+
     def serialize(self) -> dict[str, Any]:
         """Serialize."""
         result = {
@@ -267,6 +367,19 @@ class CityName(BaseModel):
 
     city = db.relationship("City", backref=db.backref("city"))
 
+    @staticmethod
+    def autocomplete_query(query: str) -> Select:
+        """The most populated cities with a name starting with the query."""
+        return (
+            select(CityName)
+            .join(CityName.city)
+            .options(contains_eager(CityName.city))
+            .filter(CityName.name.like(query + "%"))
+            .distinct(City.population, CityName.city_id)
+            .order_by(City.population.desc(), CityName.city_id)
+            .limit(10)
+        )
+
     def serialize(self) -> dict[str, Any]:
         """Serialize."""
         return {
@@ -304,6 +417,8 @@ class CityName(BaseModel):
 
 
 class Airline(BaseModel):
+    source_id = db.Column(db.Integer, unique=True)  # Airline ID in the data feed
+    checksum = db.Column(db.String(32))
     name = db.Column(db.String(128))
     alias = db.Column(db.String(64))
     iata = db.Column(db.String(4))
@@ -324,7 +439,3 @@ class Airline(BaseModel):
             "country": self.country,
             "active": self.active,
         }
-
-
-with app.app_context():
-    db.create_all()
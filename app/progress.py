@@ -0,0 +1,107 @@
+"""
+Progress and throughput reporting of import commands.
+"""
+
+from __future__ import annotations
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import json
+import resource
+from time import perf_counter
+from typing import Any, Callable, Iterable, Iterator
+
+
+class ImportProgress:  # pylint: disable=too-many-instance-attributes
+    """
+    Rows/sec, per-phase timings, rejected rows and peak memory of an import.
+
+    Phases can be nested (e.g. a DB write pulls rows from a transform that
+    pulls them from a parser), each phase is charged only its own time.
+    """
+
+    def __init__(
+        self, name: str, interval: float = 5.0, output: Callable[[str], Any] = print
+    ) -> None:
+        self.name = name
+        self.interval = interval
+        self.output = output
+        self.rows = 0
+        self.rejected: Counter = Counter()
+        self.phases: defaultdict[str, float] = defaultdict(float)
+        self._stack: list[str] = []
+        self._start = self._mark = self._last_report = perf_counter()
+
+    def _enter(self, phase: str) -> None:
+        now = perf_counter()
+        if self._stack:
+            self.phases[self._stack[-1]] += now - self._mark
+        self._stack.append(phase)
+        self._mark = now
+
+    def _exit(self) -> None:
+        now = perf_counter()
+        self.phases[self._stack.pop()] += now - self._mark
+        self._mark = now
+
+    @contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        """Time a block of code."""
+        self._enter(phase)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def iterate(
+        self, iterable: Iterable, phase: str, count: bool = False
+    ) -> Iterator[Any]:
+        """Time getting items of the iterable, optionally count them as rows."""
+        iterator = iter(iterable)
+        while True:
+            self._enter(phase)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+
+            if count:
+                self.add()
+            yield item
+
+    def add(self, rows: int = 1) -> None:
+        """Count processed rows, report progress every `interval` seconds."""
+        self.rows += rows
+        now = perf_counter()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.output(
+                f"{self.name}: {self.rows} rows, "
+                f"{self.rows / (now - self._start):.0f} rows/sec, "
+                f"{sum(self.rejected.values())} rejected"
+            )
+
+    def summary(self, **extra: Any) -> dict[str, Any]:
+        """Final statistics."""
+        seconds = perf_counter() - self._start
+        # ru_maxrss is in kilobytes on Linux, children are pool workers.
+        peak_memory = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        return {
+            "command": self.name,
+            "rows": self.rows,
+            "seconds": round(seconds, 3),
+            "rows_per_sec": round(self.rows / seconds, 1) if seconds else 0.0,
+            "phases": {phase: round(t, 3) for phase, t in self.phases.items()},
+            "rejected": dict(self.rejected),
+            "peak_memory_mb": round(peak_memory / 1024, 1),
+            **extra,
+        }
+
+    def report(self, **extra: Any) -> None:
+        """Output the final statistics as JSON."""
+        self.output(json.dumps(self.summary(**extra)))
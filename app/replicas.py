@@ -0,0 +1,106 @@
+"""
+Routing of read-only view queries to database replicas.
+
+Imports and other writes use the primary (db.engine / db.session).
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from itertools import count
+import logging
+import threading
+from typing import Iterator, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from app import app, db
+from app.cache import replicas_may_lag
+from app.resilience import CircuitBreaker
+from app.slow_queries import capture_slow_queries
+
+log = logging.getLogger(__name__)
+
+
+class Replica:
+    """Engine of a read replica and the circuit breaker of its health."""
+
+    def __init__(self, uri: str) -> None:
+        self.engine = create_engine(uri, **app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        capture_slow_queries(self.engine)
+        self.breaker = CircuitBreaker(
+            self.ping,
+            app.config["DB_REPLICA_FAILURE_THRESHOLD"],
+            app.config["DB_REPLICA_BACKOFF"],
+            app.config["DB_REPLICA_MAX_BACKOFF"],
+        )
+
+    def ping(self) -> None:
+        with self.engine.connect():
+            pass
+
+    def connection_failed(self) -> None:
+        log.warning("Replica %s is unavailable", self.engine.url)
+        self.breaker.record_failure()
+
+
+_replicas: Optional[list[Replica]] = None
+_replicas_lock = threading.Lock()
+_next_replica = count()
+
+
+def get_replicas() -> list[Replica]:
+    """Replicas of the worker, created on first use so pools aren't forked."""
+    global _replicas  # pylint: disable=global-statement
+    with _replicas_lock:
+        if _replicas is None:
+            _replicas = [Replica(uri) for uri in app.config["SQLALCHEMY_REPLICA_URIS"]]
+    return _replicas
+
+
+def available_replicas() -> Iterator[tuple[int, Replica]]:
+    """
+    Positions of replicas with closed circuits and the replicas, round robin.
+
+    Asyncio connections (app.asgi) share health of the replicas with these.
+    None are available for a while after an import, they may not have it yet.
+    """
+    if replicas_may_lag():
+        return
+    replicas = get_replicas()
+    start = next(_next_replica)
+    for i in range(len(replicas)):
+        position = (start + i) % len(replicas)
+        if replicas[position].breaker.available:
+            yield position, replicas[position]
+
+
+@contextmanager
+def read_connection() -> Iterator[Connection]:
+    """Connection to a healthy replica (round robin), the primary otherwise."""
+    for _, replica in available_replicas():
+        try:
+            conn = replica.engine.connect()
+        except OperationalError:
+            replica.connection_failed()
+            continue
+
+        replica.breaker.record_success()
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    with db.engine.connect() as conn:
+        yield conn
+
+
+@contextmanager
+def read_session() -> Iterator[Session]:
+    """ORM session bound to a read connection (see read_connection)."""
+    with read_connection() as conn, Session(bind=conn) as session:
+        yield session
@@ -0,0 +1,119 @@
+"""
+Protection of the app from failing and overloaded backends.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+import logging
+import threading
+from time import sleep
+from typing import Any, Callable, Iterator
+
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Mark a backend unavailable after consecutive failures.
+
+    While the circuit is open requests skip the backend, a background thread
+    probes it with exponential backoff and closes the circuit once it answers.
+    """
+
+    def __init__(
+        self,
+        probe: Callable[[], Any],
+        failure_threshold: int = 3,
+        backoff: float = 5.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.is_open = False
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return not self.is_open
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        """Count a failure, open the circuit when the threshold is reached."""
+        with self._lock:
+            self.failures += 1
+            if self.is_open or self.failures < self.failure_threshold:
+                return
+            self.is_open = True
+
+        log.warning("Circuit opened after %s failures", self.failures)
+        threading.Thread(target=self._probe_loop, daemon=True).start()
+
+    def _probe_loop(self) -> None:
+        backoff = self.backoff
+        while True:
+            sleep(backoff)
+            try:
+                self.probe()
+            except Exception:  # pylint: disable=broad-except
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            with self._lock:
+                self.failures = 0
+                self.is_open = False
+            log.warning("Circuit closed")
+            return
+
+
+class Overloaded(Exception):
+    """Too many computations of the namespace are running and waiting."""
+
+
+class AdmissionQueue:
+    """Bounded number of computations waiting for a slot."""
+
+    def __init__(self, queue_size: int) -> None:
+        self.queue_size = queue_size
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def queued(self) -> Iterator[None]:
+        """Count the caller as waiting, raise Overloaded if the queue is full."""
+        with self._lock:
+            if self.waiting >= self.queue_size:
+                raise Overloaded("the queue is full")
+            self.waiting += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+
+class AdmissionLimit(AdmissionQueue):
+    """Limit concurrent computations, with a bounded queue of waiting ones."""
+
+    def __init__(self, concurrency: int, queue_size: int) -> None:
+        super().__init__(queue_size)
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    @contextmanager
+    def slot(self, timeout: float) -> Iterator[None]:
+        """Wait up to `timeout` seconds for a free slot, raise Overloaded if none."""
+        if not self._slots.acquire(blocking=False):
+            with self.queued():
+                acquired = self._slots.acquire(timeout=timeout)
+            if not acquired:
+                raise Overloaded(f"no free slot in {timeout} s")
+
+        try:
+            yield
+        finally:
+            self._slots.release()
@@ -0,0 +1,143 @@
+"""
+Elasticsearch index of city names.
+"""
+
+from __future__ import annotations
+
+from time import time
+from typing import Any, Iterator
+
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch.exceptions import NotFoundError
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import text
+
+# Views search the alias, it points to the latest versioned index.
+CITY_INDEX = "airtickets-city-index"
+
+CITY_INDEX_BODY = {
+    "settings": {
+        "index": {
+            "analysis": {
+                "analyzer": {
+                    "folding": {
+                        "tokenizer": "standard",
+                        "filter": ["lowercase", "asciifolding"],
+                    }
+                }
+            }
+        }
+    },
+    "mappings": {
+        "properties": {
+            "value": {"type": "text", "analyzer": "folding"},
+            "location": {"type": "geo_point"},
+            "population": {"type": "integer"},
+            "data": {"type": "nested"},
+        }
+    },
+}
+
+
+def city_name_docs(
+    conn: Connection, index: str, batch_size: int = 5000
+) -> Iterator[dict[str, Any]]:
+    """
+    Stream city names as bulk actions (see CityName.elastic_serialize).
+
+    Rows are fetched with keyset pagination, so every batch costs the same.
+    """
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            text(
+                "SELECT cityname.id, cityname.name, cityname.city_id, "
+                "city.latitude, city.longitude, city.country_code, city.population "
+                "FROM cityname JOIN city ON city.id = cityname.city_id "
+                "WHERE cityname.id > :last_id ORDER BY cityname.id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": batch_size},
+        ).all()
+        if not rows:
+            return
+
+        for row in rows:
+            yield {
+                "_index": index,
+                "_id": row.city_id,
+                "_source": {
+                    "value": row.name,
+                    "data": {
+                        "id": row.city_id,
+                        "lng": row.longitude,
+                        "lat": row.latitude,
+                        "country_code": row.country_code,
+                    },
+                    "location": {"lat": row.latitude, "lon": row.longitude},
+                    "population": row.population or 0,
+                },
+            }
+
+        last_id = rows[-1].id
+
+
+def reindex_cities(
+    es: Elasticsearch,
+    conn: Connection,
+    thread_count: int = 4,
+    chunk_size: int = 1000,
+    keep_old: bool = False,
+) -> tuple[str, int, int]:
+    """
+    Build a new versioned index and atomically point the alias to it.
+
+    The old index keeps serving searches until the alias is swapped.
+    Return the new index name, number of indexed and failed documents.
+    """
+    index = f"{CITY_INDEX}-{int(time() * 1000)}"
+    es.indices.create(index=index, body=CITY_INDEX_BODY)
+    # Don't refresh and replicate while bulk loading.
+    es.indices.put_settings(
+        index=index,
+        body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+    )
+
+    indexed = failed = 0
+    for ok, _ in helpers.parallel_bulk(
+        es,
+        city_name_docs(conn, index),
+        thread_count=thread_count,
+        chunk_size=chunk_size,
+        raise_on_error=False,
+    ):
+        if ok:
+            indexed += 1
+        else:
+            failed += 1
+
+    es.indices.put_settings(
+        index=index,
+        body={"index": {"refresh_interval": "1s", "number_of_replicas": 1}},
+    )
+    es.indices.refresh(index=index)
+
+    try:
+        old_indexes = list(es.indices.get_alias(name=CITY_INDEX))
+    except NotFoundError:
+        old_indexes = []
+
+    actions: list[dict] = [{"add": {"index": index, "alias": CITY_INDEX}}]
+    if not old_indexes and es.indices.exists(index=CITY_INDEX):
+        # A concrete index created before the alias was introduced.
+        actions.append({"remove_index": {"index": CITY_INDEX}})
+    actions.extend(
+        {"remove": {"index": old_index, "alias": CITY_INDEX}}
+        for old_index in old_indexes
+    )
+    es.indices.update_aliases(body={"actions": actions})
+
+    if not keep_old:
+        for old_index in old_indexes:
+            es.indices.delete(index=old_index)
+
+    return index, indexed, failed
@@ -0,0 +1,298 @@
+"""
+Read-only in-memory store of cities and airports for the /ajax lookups.
+
+Records are `__slots__` objects kept in lists, cities in the order of
+population (the order the lookups rank them in), so a position is a rank.
+The store is loaded in the background when the worker starts (see
+gunicorn.conf.py) and when the cities or airports data version changes (see
+bump_data_version), lookups use the database until it's loaded.
+"""
+
+from __future__ import annotations
+
+from array import array
+from bisect import bisect_left
+import heapq
+import logging
+import math
+import threading
+from typing import Any, Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.engine import Row
+
+from app import app
+from app.cache import get_data_versions
+from app.metrics import LOCAL_CACHE_ITEMS
+from app.models import Airport, City, CityName
+from app.replicas import read_connection
+
+log = logging.getLogger(__name__)
+
+DATA = ("cities", "airports")
+
+# Autocomplete results, the most populated cities of short prefixes (they
+# match too many names to scan) are indexed.
+AUTOCOMPLETE_LIMIT = 10
+INDEXED_PREFIX_LENGTH = 3
+
+_store: Optional[ServingStore] = None
+_loading: Optional[threading.Thread] = None
+_loading_lock = threading.Lock()
+
+
+class CityRecord:  # pylint: disable=too-many-instance-attributes
+    __slots__ = (
+        "id",
+        "population",
+        "latitude",
+        "longitude",
+        "gns_ufi",
+        "gns_fd",
+        "country_code",
+        "subdivision_code",
+        "language_code",
+        "names",
+    )
+
+    def __init__(self, row: Row) -> None:
+        self.id: int = row.id
+        self.population: Optional[int] = row.population
+        self.latitude: Optional[float] = row.latitude
+        self.longitude: Optional[float] = row.longitude
+        self.gns_ufi: Optional[int] = row.gns_ufi
+        self.gns_fd: Optional[str] = row.gns_fd
+        self.country_code: Optional[str] = row.country_code
+        self.subdivision_code: Optional[str] = row.subdivision_code
+        self.language_code: Optional[str] = row.language_code
+        self.names: list[str] = []
+
+    def serialize(self) -> dict[str, Any]:
+        """Same as City.serialize."""
+        result = {field: getattr(self, field) for field in self.__slots__[:-1]}
+        result["city_names"] = list(self.names)
+        return result
+
+    def autocomplete_serialize(self, name: str) -> dict[str, Any]:
+        """Same as CityName.autocomplete_serialize."""
+        return {
+            "value": name,
+            "data": {
+                "id": self.id,
+                "lng": self.longitude,
+                "lat": self.latitude,
+                "country_code": self.country_code,
+            },
+        }
+
+
+class AirportRecord:
+    # Airport.API_COLUMNS and precomputed terms of the distance formula.
+    __slots__ = ("id", "fields", "cos_lat", "sin_lat", "rad_lng")
+
+    def __init__(self, row: Row) -> None:
+        self.id: int = row.id
+        self.fields: dict[str, Any] = row._asdict()
+        self.cos_lat = math.cos(math.radians(row.latitude))
+        self.sin_lat = math.sin(math.radians(row.latitude))
+        self.rad_lng = math.radians(row.longitude)
+
+    def distance(self, cos_lat: float, sin_lat: float, rad_lng: float) -> float:
+        """Distance in miles, the formula of Airport.closest_airports_query."""
+        cos_angle = (
+            self.cos_lat * cos_lat * math.cos(self.rad_lng - rad_lng)
+            + self.sin_lat * sin_lat
+        )
+        return 3959 * math.acos(min(1.0, max(-1.0, cos_angle)))
+
+    def serialize(self, distance: float) -> dict[str, Any]:
+        """Same as a row of Airport.get_closest_airports."""
+        return {**self.fields, "distance": distance}
+
+
+class ServingStore:  # pylint: disable=too-many-instance-attributes
+    """Cities, city names and airports with indexes for the lookups."""
+
+    def __init__(
+        self,
+        versions: list[int],
+        cities: Iterable[Row],
+        names: Iterable[Row],
+        airports: Iterable[Row],
+    ) -> None:
+        self.versions = versions
+        # By population (descending) and id, like in the SQL lookups.
+        self.cities = [CityRecord(row) for row in cities]
+        self.city_index = {city.id: i for i, city in enumerate(self.cities)}
+
+        # Sorted names and positions of their cities, for prefix search.
+        pairs = []
+        for row in names:
+            i = self.city_index[row.city_id]
+            self.cities[i].names.append(row.name)
+            pairs.append((row.name, i))
+        pairs.sort()
+        self.names = [name for name, _ in pairs]
+        self.name_cities = array("l", (i for _, i in pairs))
+
+        # Positions of the most populated cities of each short prefix.
+        top_cities: dict[str, list[int]] = {}
+        for i, city in enumerate(self.cities):
+            for name in city.names:
+                for length in range(min(len(name), INDEXED_PREFIX_LENGTH) + 1):
+                    top = top_cities.setdefault(name[:length], [])
+                    # Cities come in order, names of a city one after another.
+                    if len(top) < AUTOCOMPLETE_LIMIT and top[-1:] != [i]:
+                        top.append(i)
+        self.top_cities = {prefix: tuple(top) for prefix, top in top_cities.items()}
+
+        # Positions of located cities in 1 degree cells, in population order.
+        self.located = array("l")
+        self.grid: dict[tuple[int, int], array] = {}
+        for i, city in enumerate(self.cities):
+            if city.latitude is not None and city.longitude is not None:
+                self.located.append(i)
+                cell = (math.floor(city.latitude), math.floor(city.longitude))
+                self.grid.setdefault(cell, array("l")).append(i)
+
+        self.airports = [
+            AirportRecord(row)
+            for row in airports
+            if row.latitude is not None and row.longitude is not None
+        ]
+
+    @classmethod
+    def load(cls, versions: list[int]) -> ServingStore:
+        with app.app_context(), read_connection() as conn:
+            return cls(
+                versions,
+                conn.execute(
+                    select(*City.__table__.columns).order_by(
+                        City.population.desc(), City.id
+                    )
+                ),
+                conn.execute(
+                    select(CityName.name, CityName.city_id).order_by(CityName.id)
+                ),
+                conn.execute(
+                    select(*(Airport.__table__.c[name] for name in Airport.API_COLUMNS))
+                ),
+            )
+
+    def autocomplete(self, query: str, limit: int = AUTOCOMPLETE_LIMIT) -> list[dict]:
+        """Cities with a name starting with the query, the most populated first."""
+        if len(query) <= INDEXED_PREFIX_LENGTH and limit <= AUTOCOMPLETE_LIMIT:
+            positions: Iterable[int] = self.top_cities.get(query, ())[:limit]
+        else:
+            start = bisect_left(self.names, query)
+            end = start
+            # Names with the prefix are next to each other.
+            while end < len(self.names) and self.names[end].startswith(query):
+                end += 1
+            positions = heapq.nsmallest(limit, set(self.name_cities[start:end]))
+
+        result = []
+        for i in positions:
+            city = self.cities[i]
+            name = min(name for name in city.names if name.startswith(query))
+            result.append(city.autocomplete_serialize(name))
+        return result
+
+    def cities_in_area(
+        self, ne_lng: float, ne_lat: float, sw_lng: float, sw_lat: float
+    ) -> list[dict]:
+        """The most populated cities in the area, City.in_area_query results."""
+        candidates: Iterable[int] = self.located
+        bounds = (ne_lng, ne_lat, sw_lng, sw_lat)
+        if all(math.isfinite(bound) for bound in bounds):
+            lats = range(math.floor(sw_lat), math.floor(ne_lat) + 1)
+            lngs = range(math.floor(sw_lng), math.floor(ne_lng) + 1)
+            cells = max(0, lats.stop - lats.start) * max(0, lngs.stop - lngs.start)
+            # Merge cells of a small area, scan all cities for a large one.
+            if cells < len(self.grid):
+                candidates = heapq.merge(
+                    *(self.grid.get((lat, lng), ()) for lat in lats for lng in lngs)
+                )
+
+        result = []
+        for i in candidates:
+            city = self.cities[i]
+            if sw_lng < city.longitude < ne_lng and sw_lat < city.latitude < ne_lat:
+                result.append(city.serialize())
+                if len(result) == 10:
+                    break
+        return result
+
+    def closest_airports(self, lat: float, lng: float, limit: int = 1) -> list[dict]:
+        """The closest airports, Airport.get_closest_airports results."""
+        cos_lat = math.cos(math.radians(lat))
+        sin_lat = math.sin(math.radians(lat))
+        rad_lng = math.radians(lng)
+        closest = heapq.nsmallest(
+            limit,
+            (
+                (airport.distance(cos_lat, sin_lat, rad_lng), airport.id, airport)
+                for airport in self.airports
+            ),
+        )
+        return [airport.serialize(distance) for distance, _, airport in closest]
+
+
+def get_store() -> Optional[ServingStore]:
+    """
+    Store of the current data, None if SERVING_STORE is disabled or the store
+    isn't loaded yet (it's being loaded in the background then).
+    """
+    if not app.config["SERVING_STORE"]:
+        return None
+
+    store = _store
+    if store is None or store.versions != get_data_versions(DATA):
+        load_store()
+        return None
+    return store
+
+
+def load_store() -> Optional[threading.Thread]:
+    """Load the store of the current data in a thread, unless it's loading."""
+    global _loading  # pylint: disable=global-statement
+    if not app.config["SERVING_STORE"]:
+        return None
+
+    with _loading_lock:
+        if _loading is None or not _loading.is_alive():
+            _loading = threading.Thread(target=_load, name="serving-store", daemon=True)
+            _loading.start()
+        return _loading
+
+
+def _load() -> None:
+    global _store  # pylint: disable=global-statement
+    try:
+        versions = get_data_versions(DATA)
+        if _store is not None and _store.versions == versions:
+            return
+        store = ServingStore.load(versions)
+    except Exception:  # pylint: disable=broad-except
+        log.exception("Serving store isn't loaded")
+        return
+
+    log.info(
+        "Serving store loaded: %d cities, %d names, %d airports",
+        len(store.cities),
+        len(store.names),
+        len(store.airports),
+    )
+    LOCAL_CACHE_ITEMS.labels("serving_cities").set(len(store.cities))
+    LOCAL_CACHE_ITEMS.labels("serving_names").set(len(store.names))
+    LOCAL_CACHE_ITEMS.labels("serving_airports").set(len(store.airports))
+    _store = store
+
+
+def reset_store() -> None:
+    """Drop the store (once it's loaded), the next lookup loads it again."""
+    global _store  # pylint: disable=global-statement
+    loading = _loading
+    if loading is not None:
+        loading.join()
+    _store = None
@@ -0,0 +1,197 @@
+"""
+Capture of slow SQL queries with their EXPLAIN plans.
+
+Queries running longer than SLOW_QUERY_THRESHOLD, and queries cancelled by
+statement_timeout, are pushed to a capped Redis list by a background thread.
+A sample of the completed ones (SLOW_QUERY_EXPLAIN_RATE) is re-run with
+EXPLAIN (ANALYZE, BUFFERS) first, so the plan is recorded too.
+`manage.py slow_queries` summarizes the list by query shape.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import random
+import re
+from time import perf_counter, time
+from typing import Any, Optional
+
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine, ExceptionContext
+
+from app import app, db, redis_store
+
+log = logging.getLogger(__name__)
+
+SLOW_QUERIES_KEY = "slow_queries"
+
+# SQLSTATE of statements cancelled by statement_timeout.
+QUERY_CANCELED = "57014"
+
+# Connections running the EXPLAIN aren't captured themselves.
+SKIP_OPTION = "skip_slow_query_capture"
+
+# One thread, so EXPLAIN ANALYZE doesn't add much load to a slow database.
+_executor = ThreadPoolExecutor(1, thread_name_prefix="slow-queries")
+
+
+def query_shape(statement: str) -> str:
+    """Statement without comments, parameters and whitespace differences."""
+    shape = re.sub(r"--[^\n]*", "", statement)
+    shape = re.sub(r"%\(\w+\)s|\$\d+|%s", "?", shape)
+    # IN lists with any number of parameters are the same shape.
+    shape = re.sub(r"\?(\s*,\s*\?)+", "?...", shape)
+    return " ".join(shape.split())
+
+
+# Listeners take the arguments of the cursor execute events.
+# pylint: disable=too-many-positional-arguments
+
+
+def _before_execute(conn: Connection, cursor, statement, parameters, context, many):
+    context.slow_query_start = perf_counter()
+
+
+def _after_execute(conn: Connection, cursor, statement, parameters, context, many):
+    duration = (perf_counter() - context.slow_query_start) * 1000
+    if duration >= app.config["SLOW_QUERY_THRESHOLD"] and not many:
+        _record(conn, statement, parameters, duration)
+
+
+# pylint: enable=too-many-positional-arguments
+
+
+def _handle_error(context: ExceptionContext) -> None:
+    """Record statements cancelled by statement_timeout, however long they ran."""
+    execution = context.execution_context
+    cancelled = getattr(context.original_exception, "pgcode", None) == QUERY_CANCELED
+    if not cancelled or execution is None or context.connection is None:
+        return
+
+    start = getattr(execution, "slow_query_start", None)
+    duration = (perf_counter() - start) * 1000 if start is not None else None
+    _record(
+        context.connection,
+        context.statement,
+        context.parameters,
+        duration,
+        cancelled=True,
+    )
+
+
+def _record(
+    conn: Connection,
+    statement: str,
+    parameters: Any,
+    duration: Optional[float],
+    cancelled: bool = False,
+) -> None:
+    if conn.get_execution_options().get(SKIP_OPTION):
+        return
+
+    record = {
+        "timestamp": time(),
+        "duration_ms": round(duration or 0, 1),
+        "statement": statement,
+        "parameters": parameters,
+        "cancelled": cancelled,
+    }
+    # ANALYZE runs the query again, only read queries of sync drivers are
+    # explained, cancelled ones would just run into the timeout again.
+    explain = (
+        not cancelled
+        and not conn.dialect.is_async
+        and statement.lstrip().upper().startswith(("SELECT", "WITH"))
+        and random.random() < app.config["SLOW_QUERY_EXPLAIN_RATE"]
+    )
+    _executor.submit(_capture, conn.engine, record, explain)
+
+
+def _explain(engine: Engine, statement: str, parameters: Any) -> Optional[list]:
+    with engine.connect() as conn:
+        conn = conn.execution_options(**{SKIP_OPTION: True})
+        conn.exec_driver_sql(
+            "SELECT set_config('statement_timeout', %(timeout)s, true)",
+            {"timeout": str(app.config["SLOW_QUERY_EXPLAIN_TIMEOUT"])},
+        )
+        return conn.exec_driver_sql(
+            f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters
+        ).scalar()
+
+
+def _capture(engine: Engine, record: dict[str, Any], explain: bool) -> None:
+    if explain:
+        try:
+            record["plan"] = _explain(engine, record["statement"], record["parameters"])
+        except Exception:  # pylint: disable=broad-except
+            log.warning("Can't explain a slow query", exc_info=True)
+
+    try:
+        pipe = redis_store.pipeline()
+        pipe.lpush(SLOW_QUERIES_KEY, json.dumps(record, default=str))
+        pipe.ltrim(SLOW_QUERIES_KEY, 0, app.config["SLOW_QUERY_LOG_SIZE"] - 1)
+        pipe.execute()
+    except RedisError:
+        log.warning("Can't save a slow query", exc_info=True)
+
+
+def capture_slow_queries(engine: Engine) -> None:
+    """Record slow queries of the engine (use `sync_engine` of async ones)."""
+    if not event.contains(engine, "before_cursor_execute", _before_execute):
+        event.listen(engine, "before_cursor_execute", _before_execute)
+        event.listen(engine, "after_cursor_execute", _after_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+with app.app_context():
+    capture_slow_queries(db.engine)
+
+
+def wait_for_captures() -> None:
+    """Block until captured queries are saved."""
+    _executor.submit(lambda: None).result()
+
+
+def summarize(records: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Group queries by shape, the worst (by total time) first."""
+    shapes: dict[str, dict[str, Any]] = defaultdict(
+        lambda: {"count": 0, "cancelled": 0, "total_ms": 0.0, "max_ms": 0.0}
+    )
+    for record in records:
+        shape = shapes[query_shape(record["statement"])]
+        shape["count"] += 1
+        shape["cancelled"] += record.get("cancelled", False)
+        shape["total_ms"] += record["duration_ms"]
+        if record["duration_ms"] >= shape["max_ms"]:
+            shape["max_ms"] = record["duration_ms"]
+            shape["slowest_parameters"] = record["parameters"]
+        if record.get("plan") and record["duration_ms"] >= shape.get("plan_ms", 0):
+            shape["plan_ms"] = record["duration_ms"]
+            shape["plan"] = record["plan"]
+
+    result = [
+        {"shape": shape, "avg_ms": round(s["total_ms"] / s["count"], 1), **s}
+        for shape, s in shapes.items()
+    ]
+    return sorted(result, key=lambda s: s["total_ms"], reverse=True)
+
+
+def plan_summary(plan: list[dict[str, Any]]) -> str:
+    """Top node, execution time and buffers of an EXPLAIN (FORMAT JSON) plan."""
+    root = plan[0]["Plan"]
+    return (
+        f"{root['Node Type']}, executed in {plan[0]['Execution Time']} ms, "
+        f"shared buffers hit {root.get('Shared Hit Blocks', 0)} "
+        f"read {root.get('Shared Read Blocks', 0)}"
+    )
+
+
+def load_slow_queries() -> list[dict[str, Any]]:
+    """Captured queries, the latest first."""
+    return [
+        json.loads(record) for record in redis_store.lrange(SLOW_QUERIES_KEY, 0, -1)
+    ]
@@ -117,6 +117,7 @@ $(document).ready(function () {
             j,
             k,
             s,
+            airport,
             $li,
             $container,
             $jsRoutes = $("#js-routes"),
@@ -128,7 +129,7 @@ $(document).ready(function () {
         if (formData) {
             /*jslint unparam: true*/
             $.ajax({
-                url: "/ajax/routes?" + formData,
+                url: "/ajax/routes?format=normalized&" + formData,
                 type: "GET",
                 dataType: "json",
                 success(data) {
@@ -145,11 +146,12 @@ $(document).ready(function () {
                                     $li = $("<li />");
                                     $li.data("route", []);
                                     for (j = 0; j < data.routes[i][k].nodes.length; j += 1) {
+                                        airport = data.airports[data.routes[i][k].nodes[j]];
                                         $li.data("route").push({
-                                            lat: parseFloat(data.routes[i][k].nodes[j].latitude),
-                                            lng: parseFloat(data.routes[i][k].nodes[j].longitude)
+                                            lat: parseFloat(airport.latitude),
+                                            lng: parseFloat(airport.longitude)
                                         });
-                                        s = "<span>" + data.routes[i][k].nodes[j].airport_name + "</span>";
+                                        s = "<span>" + airport.airport_name + "</span>";
                                         if (j < data.routes[i][k].nodes.length - 1) {
                                             s += " - ";
                                         } else {
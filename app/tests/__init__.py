@@ -1,6 +1,7 @@
 from flask_testing import TestCase
 
-from app import app, db, redis_store
+from app import app, cache, db, redis_store
+from app.cache import local_cache, data_versions, known_data_versions
 
 
 class BaseTestCase(TestCase):
@@ -14,3 +15,7 @@ class BaseTestCase(TestCase):
         db.session.remove()
         db.drop_all()
         redis_store.flushall()
+        local_cache.clear()
+        data_versions.clear()
+        known_data_versions.clear()
+        cache._replicas_lag_until = 0.0
@@ -0,0 +1,212 @@
+import pickle
+import threading
+from unittest import mock
+
+from prometheus_client import REGISTRY
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from app import redis_store
+from app.cache import (
+    AdmissionLimit,
+    LRUCache,
+    Overloaded,
+    admission_limits,
+    local_cache,
+    redis_breaker,
+    cache_get,
+    cache_set,
+    cache_get_or_set,
+    cached,
+    make_key,
+    bump_data_version,
+    data_versions,
+    get_data_versions,
+)
+from app.tests import BaseTestCase
+
+
+class AirticketsCacheTest(BaseTestCase):
+    """Test the two-tier cache."""
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1, 60)
+        cache.set("b", 2, 60)
+        self.assertEqual(cache.get("a"), 1)
+
+        # "b" is the least recently used item now.
+        cache.set("c", 3, 60)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertDictEqual(
+            cache.stats(),
+            {
+                "size": 2,
+                "max_size": 2,
+                "hits": 2,
+                "misses": 1,
+                "evictions": 1,
+                "hit_ratio": 2 / 3,
+            },
+        )
+
+    def test_lru_cache_ttl(self):
+        cache = LRUCache()
+        with mock.patch("app.cache.monotonic", return_value=100):
+            cache.set("a", [], 10)
+            self.assertEqual(cache.get("a"), [])
+        with mock.patch("app.cache.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_cache_get_set(self):
+        self.assertIsNone(cache_get("routes|1|2", "routes"))
+
+        cache_set("routes|1|2", {1: []}, "routes")
+        self.assertEqual(local_cache.get("routes|1|2"), {1: []})
+
+        # Value is still in Redis after the local cache was cleared.
+        local_cache.clear()
+        self.assertEqual(cache_get("routes|1|2", "routes"), {1: []})
+        self.assertEqual(local_cache.get("routes|1|2"), {1: []})
+
+    def test_redis_outage(self):
+        with mock.patch(
+            "app.cache.redis_store.get", side_effect=RedisConnectionError
+        ) as redis_get, mock.patch(
+            "app.resilience.threading.Thread"
+        ) as thread, mock.patch.object(
+            redis_breaker, "failures", 0
+        ):
+            for _ in range(redis_breaker.failure_threshold + 2):
+                self.assertIsNone(cache_get("routes|1|2", "routes"))
+
+            # Redis is skipped once the circuit is open.
+            self.assertEqual(redis_get.call_count, redis_breaker.failure_threshold)
+            self.assertFalse(redis_breaker.available)
+            thread.assert_called_once()
+
+            # Background probe closes the circuit.
+            with mock.patch("app.resilience.sleep"):
+                redis_breaker._probe_loop()
+            self.assertTrue(redis_breaker.available)
+
+    def test_cache_get_or_set(self):
+        compute = mock.Mock(return_value=[1, 2])
+        self.assertEqual(cache_get_or_set("routes|1|2", "routes", compute), [1, 2])
+        self.assertEqual(cache_get_or_set("routes|1|2", "routes", compute), [1, 2])
+        compute.assert_called_once()
+        # The lock was released.
+        self.assertFalse(redis_store.exists("lock|routes|1|2"))
+
+    def test_cache_get_or_set_locked(self):
+        """Another worker computes the key, wait for it."""
+        redis_store.set("lock|routes|1|2", "other worker")
+        timer = threading.Timer(
+            0.1, lambda: redis_store.set("routes|1|2", pickle.dumps([3]))
+        )
+        timer.start()
+        compute = mock.Mock(return_value=[1, 2])
+        self.assertEqual(cache_get_or_set("routes|1|2", "routes", compute), [3])
+        compute.assert_not_called()
+        timer.join()
+
+    def test_make_key(self):
+        self.assertEqual(
+            make_key("airports", 49.0, 23.00000001, 5, True),
+            "airports|v3|0.0|49.0|23.0|5|1",
+        )
+        self.assertEqual(
+            make_key("autocomplete_cities", "a|b c"),
+            "autocomplete_cities|v3|0|a%7Cb%20c",
+        )
+
+    def test_cached(self):
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, {"namespace": "airports", **labels})
+
+        # Metrics are process-wide, compare with values before the test.
+        requests = "airtickets_cache_requests_total"
+        hits = sample(requests, result="hit") or 0
+        misses = sample(requests, result="miss") or 0
+        miss_count = sample("airtickets_cache_miss_duration_seconds_count") or 0
+        payload = sample("airtickets_cache_payload_bytes_sum") or 0
+
+        compute = mock.Mock(return_value={"a": 1})
+        cached_compute = cached("airports")(compute)
+        for _ in range(3):
+            self.assertDictEqual(cached_compute(49.0, 23.0), {"a": 1})
+        compute.assert_called_once_with(49.0, 23.0)
+
+        self.assertEqual(sample(requests, result="hit"), hits + 2)
+        self.assertEqual(sample(requests, result="miss"), misses + 1)
+        self.assertEqual(
+            sample("airtickets_cache_miss_duration_seconds_count"), miss_count + 1
+        )
+        self.assertEqual(
+            sample("airtickets_cache_payload_bytes_sum"),
+            payload + len(pickle.dumps({"a": 1})),
+        )
+
+    def test_bump_data_version(self):
+        compute = mock.Mock(return_value=[1])
+        cached_compute = cached("routes")(compute)
+        cached_compute(1, 2)
+
+        # Routes depend on airports.
+        bump_data_version("airports")
+        self.assertEqual(make_key("routes", 1, 2), "routes|v3|0.1|1|2")
+        cached_compute(1, 2)
+        self.assertEqual(compute.call_count, 2)
+
+        # Routes don't depend on cities.
+        bump_data_version("cities")
+        cached_compute(1, 2)
+        self.assertEqual(compute.call_count, 2)
+
+    def test_data_versions_outage(self):
+        bump_data_version("airports")
+        self.assertEqual(get_data_versions(("routes", "airports")), [0, 1])
+
+        # The last known versions are used while Redis is unavailable.
+        data_versions.clear()
+        with mock.patch(
+            "app.cache.redis_store.mget", side_effect=RedisConnectionError
+        ), mock.patch.object(redis_breaker, "failures", 0):
+            self.assertEqual(get_data_versions(("routes", "airports")), [0, 1])
+
+    def test_admission_limit(self):
+        limit = AdmissionLimit(1, 1)
+        started, release = threading.Event(), threading.Event()
+
+        def compute():
+            with limit.slot(1):
+                started.set()
+                release.wait(1)
+
+        thread = threading.Thread(target=compute)
+        thread.start()
+        started.wait(1)
+        with self.assertRaises(Overloaded):
+            with limit.slot(0.05):
+                pass
+        release.set()
+        thread.join()
+        with limit.slot(0.05):
+            self.assertEqual(limit.waiting, 0)
+
+    def test_load_shedding(self):
+        compute = mock.Mock(return_value=[1])
+        cached_compute = cached("routes")(compute)
+        cached_compute(1, 2)
+
+        # Computations of the routes aren't admitted, the previous result is served.
+        bump_data_version("routes")
+        with mock.patch.dict(admission_limits, {"routes": AdmissionLimit(0, 0)}):
+            self.assertEqual(cached_compute(1, 2), [1])
+            self.assertEqual(compute.call_count, 1)
+
+            redis_store.flushdb()
+            local_cache.clear()
+            with self.assertRaises(Overloaded):
+                cached_compute(1, 2)
@@ -0,0 +1,116 @@
+import os
+from unittest import mock
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app
+from app.city_import import (
+    POPULATION_TOLERANCE,
+    _cell,
+    find_population,
+    read_chunks,
+    transform_cities,
+)
+from app.models import City, CityName
+from app.tests import BaseTestCase
+from manage import import_cities
+
+FILE_NAME = os.path.join(os.path.dirname(__file__), "data", "worldcities.csv")
+
+
+class AirticketsCityImportTest(BaseTestCase):
+    """Test the cities pipeline on a small worldcities file."""
+
+    def setUp(self):
+        super().setUp()
+        with open(FILE_NAME, encoding="utf-8") as f:
+            header = f.readline().rstrip("\n").split(",")
+            self.lines = f.readlines()
+        self.columns = {name: i for i, name in enumerate(header)}
+
+    def test_find_population(self):
+        # Just below a cell boundary, cities across it are matched too.
+        lat = 2 * POPULATION_TOLERANCE - 0.0001
+        populations = {
+            _cell(lat, 1.0): [
+                (1, "lviv", "UA", lat, 1.0, 720000),
+                (2, "lwow", "UA", lat, 1.0, 1),
+            ]
+        }
+        with mock.patch("app.city_import._populations", populations):
+            self.assertNotEqual(_cell(lat + 0.001, 1.0), _cell(lat, 1.0))
+            self.assertEqual(find_population(lat + 0.001, 1.0, "UA", {"lviv"}), 720000)
+            # The first population in the file of any of the names.
+            self.assertEqual(find_population(lat, 1.0, "UA", {"lwow", "lviv"}), 720000)
+            self.assertEqual(find_population(lat, 1.0, "UA", {"lwow"}), 1)
+            self.assertEqual(find_population(lat, 1.0, "PL", {"lviv"}), 0)
+            self.assertEqual(find_population(lat + 0.05, 1.0, "UA", {"lviv"}), 0)
+
+    def test_transform_cities(self):
+        populations = {
+            _cell(42.5, 1.516667): [
+                (1, "andorra la vella", "AD", 42.5, 1.5166667, 20430)
+            ]
+        }
+        with mock.patch("app.city_import._populations", populations), mock.patch(
+            "app.city_import._columns", self.columns
+        ):
+            cities, names = transform_cities(10, self.lines[:3])
+
+        # Rows of a location give one city, its population is matched by an alias.
+        self.assertEqual(
+            cities,
+            [
+                (10, -1, 42.5, 1.516667, "ad", "07", "PPLC", "ca", 20430),
+                (12, 10735690, 33.175678, 68.730449, "af", "29", "PPLA", "ps", 0),
+            ],
+        )
+        self.assertEqual(
+            names,
+            [
+                (10, "latin", "Andorra Vella", 42.5, 1.516667),
+                (11, "latin", "Andorra la Vella", 42.5, 1.516667),
+                (12, "", "Sharan", 33.175678, 68.730449),
+            ],
+        )
+
+    def test_read_chunks(self):
+        chunks = list(read_chunks(iter(self.lines), 2, self.columns))
+        # Canillo rows are the 4th and 5th, they stay in one chunk.
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 3])
+        self.assertEqual(sum(chunks, []), self.lines)
+
+    def test_commands_import_cities(self):
+        runner = app.test_cli_runner()
+        with mock.patch("manage.chunk_size", 2):
+            result = runner.invoke(
+                import_cities, ["--file-name", FILE_NAME, "--workers", "1"]
+            )
+        assert result.exit_code == 0
+        self.assertIn("3 cities inserted, 0 updated, 5 names", result.output)
+
+        self.assertEqual(
+            {city.gns_ufi: city.population for city in City.query},
+            {-1: 20430, 10735690: 0, -2: 3292},
+        )
+        canillo = City.query.filter_by(gns_ufi=-2).one()
+        self.assertEqual(
+            [name.name for name in canillo.city_names], ["Канільо", "Canillo"]
+        )
+
+        # A plain re-run fails on existing locations, nothing is added.
+        result = runner.invoke(import_cities, ["--file-name", FILE_NAME])
+        self.assertIsInstance(result.exception, IntegrityError)
+        self.assertEqual(City.query.count(), 3)
+        self.assertEqual(CityName.query.count(), 5)
+
+        # Nothing is added again.
+        with mock.patch("manage.chunk_size", 2):
+            result = runner.invoke(
+                import_cities,
+                ["--file-name", FILE_NAME, "--workers", "1", "--incremental"],
+            )
+        assert result.exit_code == 0
+        self.assertIn("0 cities inserted, 0 updated, 0 names", result.output)
+        self.assertEqual(City.query.count(), 3)
+        self.assertEqual(CityName.query.count(), 5)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+import requests
+
+from app import config
+
+
+class AirticketsConfigTest(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache_dir = os.path.join(directory, "airtickets")
+        for name, value in (
+            ("METADATA_CACHE_DIR", cache_dir),
+            ("METADATA_CACHE_FILE", os.path.join(cache_dir, "metadata.json")),
+        ):
+            patcher = mock.patch.object(config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_metadata_cache(self):
+        self.assertIsNone(config._read_metadata_cache())
+
+        config._write_metadata_cache({"AIRTICKETS_DB_USER": "user"}, True)
+        self.assertEqual(os.stat(config.METADATA_CACHE_FILE).st_mode & 0o777, 0o600)
+        self.assertEqual(config._read_metadata_cache(), {"AIRTICKETS_DB_USER": "user"})
+        # The temporary file was renamed.
+        self.assertEqual(os.listdir(config.METADATA_CACHE_DIR), ["metadata.json"])
+
+        # A file others can write isn't trusted.
+        os.chmod(config.METADATA_CACHE_FILE, 0o666)
+        self.assertIsNone(config._read_metadata_cache())
+
+    def test_get_metadata(self):
+        with mock.patch(
+            "app.config.requests.get", side_effect=requests.exceptions.Timeout
+        ):
+            self.assertEqual(config.get_metadata.__wrapped__(), {})
+        self.assertIsNone(config._read_metadata_cache())
+
+        with mock.patch(
+            "app.config.requests.get", side_effect=requests.exceptions.ConnectionError
+        ):
+            self.assertEqual(config.get_metadata.__wrapped__(), {})
+        self.assertEqual(config._read_metadata_cache(), {})
+
+    def test_metadata_cache_owner(self):
+        config._write_metadata_cache({"AIRTICKETS_DB_USER": "user"}, True)
+        with mock.patch("app.config.os.getuid", return_value=os.getuid() + 1):
+            self.assertIsNone(config._read_metadata_cache())
@@ -0,0 +1,100 @@
+from unittest import mock
+
+from app import app, db, redis_store
+from app.cache import bump_data_version, local_cache
+from app.models import Airport, City, CityName
+from app.serving import get_store, load_store, reset_store
+from app.tests import BaseTestCase
+
+
+class AirticketsServingTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        reset_store()
+        lviv = City(latitude=49.84, longitude=24.03, population=720000)
+        lviv.city_names.extend([CityName(name="Lviv"), CityName(name="Lwow")])
+        vynnyky = City(latitude=49.82, longitude=24.13, population=17000)
+        vynnyky.city_names.append(CityName(name="Vynnyky"))
+        lutsk = City(latitude=50.75, longitude=25.34, population=215000)
+        lutsk.city_names.append(CityName(name="Lutsk"))
+        db.session.add_all(
+            [
+                lviv,
+                vynnyky,
+                lutsk,
+                Airport(id=1, airport_name="Lviv", latitude=49.81, longitude=23.95),
+                Airport(id=2, airport_name="Kyiv", latitude=50.34, longitude=30.89),
+                Airport(id=3, airport_name="Lutsk", latitude=50.68, longitude=25.49),
+            ]
+        )
+        db.session.commit()
+
+    def tearDown(self):
+        reset_store()
+        super().tearDown()
+
+    def test_same_as_sql(self):
+        urls = (
+            "/ajax/autocomplete/cities?query=L",
+            "/ajax/autocomplete/cities?query=Lw",
+            "/ajax/get-cities?ne_lng=26.0&ne_lat=51.0&sw_lng=23.0&sw_lat=49.0",
+            "/ajax/get-cities?ne_lng=24.1&ne_lat=50.0&sw_lng=24.0&sw_lat=49.0",
+            "/ajax/get-cities?ne_lng=180.0&ne_lat=90.0&sw_lng=-180.0&sw_lat=-90.0",
+            "/ajax/airports?lat=49.0&lng=23.0&limit=2",
+        )
+        expected = {url: self.client.get(url).json for url in urls}
+        self.assertEqual(
+            set(expected[urls[-1]]["airports"][0]),
+            {*Airport.API_COLUMNS, "distance"},
+        )
+        # Compute them again instead of getting the results cached by SQL lookups.
+        redis_store.flushdb()
+        local_cache.clear()
+
+        with mock.patch.dict(app.config, SERVING_STORE=True):
+            load_store().join()
+            for url in urls:
+                response = self.client.get(url)
+                self.assert200(response)
+                result = response.json
+                for airport, sql_airport in zip(
+                    result.get("airports", []), expected[url].get("airports", [])
+                ):
+                    self.assertAlmostEqual(
+                        airport.pop("distance"), sql_airport.pop("distance")
+                    )
+                self.assertEqual(result, expected[url], url)
+
+    def test_reload(self):
+        with mock.patch.dict(app.config, SERVING_STORE=True):
+            # Lookups use the database while the store is loading.
+            self.assertIsNone(get_store())
+            load_store().join()
+            store = get_store()
+            self.assertIs(get_store(), store)
+            self.assertEqual(len(store.cities), 3)
+            self.assertEqual(store.autocomplete("Lw")[0]["value"], "Lwow")
+
+            db.session.add(
+                Airport(id=4, airport_name="Odesa", latitude=46, longitude=31)
+            )
+            db.session.commit()
+            bump_data_version("airports")
+            self.assertIsNone(get_store())
+            load_store().join()
+            store = get_store()
+            self.assertEqual(len(store.airports), 4)
+
+    def test_autocomplete(self):
+        with mock.patch.dict(app.config, SERVING_STORE=True):
+            load_store().join()
+            store = get_store()
+
+        # Short prefixes are indexed, longer ones are scanned.
+        for query in ("", "L", "Lu", "Lut", "Lutsk", "Lviv", "X"):
+            expected = [
+                city.autocomplete_serialize()
+                for city in db.session.scalars(CityName.autocomplete_query(query))
+            ]
+            self.assertEqual(store.autocomplete(query), expected, query)
+        self.assertEqual(len(store.autocomplete("L", limit=1)), 1)
@@ -1,6 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import gzip
+import json
+from time import perf_counter, sleep
+from unittest import mock
+
+from prometheus_client import REGISTRY
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+from app import app, db, redis_store
+from app.cache import AdmissionLimit, admission_limits, bump_data_version
+from app.compression import compressed_cache
+from app.models import Airport, QueryTimeout, Route
 from app.tests import BaseTestCase
 
 
@@ -44,6 +57,45 @@ class AirticketsViewTest(BaseTestCase):
         test()  # first run.
         test()  # second run, to check cached result.
 
+    def test_airports_concurrent_lookups(self):
+        def slow(value):
+            def f(*_):
+                sleep(0.3)
+                return value
+
+            return f
+
+        url = "/ajax/airports?lat=49.0&lng=23.0&limit=1&find_closest_city=true"
+        with mock.patch(
+            "app.models.Airport.get_closest_airports", slow([])
+        ), mock.patch("app.views._closest_city", slow({"value": "Lviv"})):
+            start = perf_counter()
+            response = self.client.get(url)
+            self.assertLess(perf_counter() - start, 0.55)
+        self.assertEqual(
+            response.json, {"airports": [], "closest_city": {"value": "Lviv"}}
+        )
+
+        # Answered without the city, the incomplete result isn't cached.
+        url = url.replace("49.0", "48.0")
+        closest_city = mock.Mock(side_effect=slow({"value": "Lviv"}))
+        with mock.patch.dict(app.config, {"CLOSEST_CITY_TIMEOUT": 0.1}), mock.patch(
+            "app.views._closest_city", closest_city
+        ):
+            for _ in range(2):
+                response = self.client.get(url)
+                self.assertEqual(response.json, {"airports": [], "closest_city": None})
+                self.assertNotIn("ETag", response.headers)
+                self.assertEqual(response.headers["Cache-Control"], "no-store")
+        self.assertEqual(closest_city.call_count, 2)
+
+        # A lookup still queued for a fan-out thread is cancelled.
+        future = mock.Mock(**{"result.side_effect": FutureTimeoutError})
+        with mock.patch("app.views._fanout.submit", return_value=future):
+            response = self.client.get(url.replace("48.0", "47.0"))
+        self.assertEqual(response.json["closest_city"], None)
+        future.cancel.assert_called_once_with()
+
     def test_routes_page(self):
         def test():
             response = self.client.get(
@@ -54,6 +106,158 @@ class AirticketsViewTest(BaseTestCase):
         test()  # first run.
         test()  # second run, to check cached result.
 
+    def test_routes_normalized(self):
+        db.session.add_all(
+            [
+                Airport(id=1, airport_name="Lviv", latitude=49.81, longitude=23.95),
+                Airport(id=2, airport_name="Kyiv", latitude=50.34, longitude=30.89),
+                Route(source=1, destination=2, distance=470),
+            ]
+        )
+        db.session.commit()
+
+        url = "/ajax/routes?from_airport=1&to_airport=2"
+        normalized = self.client.get(url + "&format=normalized").json
+        self.assertEqual(
+            normalized["routes"], {"1": [{"nodes": [1, 2], "total_distance": 470}]}
+        )
+        self.assertEqual(normalized["airports"]["2"]["airport_name"], "Kyiv")
+
+        routes = self.client.get(url).json["routes"]
+        self.assertEqual(
+            routes["1"][0]["nodes"],
+            [normalized["airports"]["1"], normalized["airports"]["2"]],
+        )
+
+    def test_compression(self):
+        url = "/ajax/autocomplete/cities?query=q"
+        plain = self.client.get(url)
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertEqual(plain.headers["Vary"], "Accept-Encoding")
+
+        compressed_cache.clear()
+        with mock.patch.dict(app.config, {"COMPRESSION_MIN_SIZE": 0}):
+            for _ in range(2):
+                response = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+                self.assertEqual(response.headers["Content-Encoding"], "gzip")
+                self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertEqual(compressed_cache.hits, 1)
+
+    def test_conditional_requests(self):
+        url = "/ajax/autocomplete/cities?query=Lv"
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(response.headers["Cache-Control"], "public, max-age=3600")
+        self.assertNotEqual(self.client.get(url + "v").headers["ETag"], etag)
+
+        with mock.patch("app.views._autocomplete_cities") as lookup:
+            response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertStatus(response, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+        lookup.assert_not_called()
+
+        bump_data_version("cities")
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assert200(response)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_stale_response(self):
+        url = "/ajax/routes?from_airport=1&to_airport=2"
+        self.assert200(self.client.get(url))
+
+        # The previous result is served, it may not match the current ETag.
+        bump_data_version("routes")
+        with mock.patch.dict(admission_limits, {"routes": AdmissionLimit(0, 0)}):
+            response = self.client.get(url)
+        self.assert200(response)
+        self.assertNotIn("ETag", response.headers)
+        self.assertEqual(response.headers["Cache-Control"], "no-store")
+
+        response = self.client.get(url)
+        self.assertIn("ETag", response.headers)
+        self.assertEqual(response.headers["Cache-Control"], "public, max-age=600")
+
+    def test_server_timing(self):
+        url = "/ajax/routes?from_airport=1&to_airport=2"
+        response = self.client.get(url)
+        metrics = response.headers["Server-Timing"].split(", ")
+        self.assertTrue(metrics[0].startswith("redis;dur="))
+        self.assertIn('cache;desc="miss"', metrics)
+        self.assertTrue(metrics[-1].startswith("total;dur="))
+        self.assertTrue(any(metric.startswith("sql;dur=") for metric in metrics))
+
+        with mock.patch.dict(app.config, {"SERVER_TIMING_LOG": True}):
+            with self.assertLogs("app.timing") as logs:
+                response = self.client.get(url)
+        self.assertIn('cache;desc="local"', response.headers["Server-Timing"])
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["path"], "/ajax/routes")
+        self.assertEqual(line["cache"], "local")
+        self.assertEqual(line["payload_bytes"], len(response.data))
+
+        # Pages aren't instrumented.
+        self.assertNotIn("Server-Timing", self.client.get("/").headers)
+
+    def test_metrics(self):
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        hits = sample(
+            "airtickets_cache_requests_total", namespace="get_cities", result="hit"
+        )
+        fallbacks = sample("airtickets_backend_fallbacks_total", lookup="get_cities")
+        url = "/ajax/get-cities?ne_lng=25.0&ne_lat=51.0&sw_lng=24.0&sw_lat=50.0"
+        self.client.get(url)
+        self.client.get(url)
+
+        self.assertEqual(
+            sample(
+                "airtickets_cache_requests_total", namespace="get_cities", result="hit"
+            ),
+            hits + 1,
+        )
+        # Elasticsearch isn't configured in tests.
+        self.assertEqual(
+            sample("airtickets_backend_fallbacks_total", lookup="get_cities"),
+            fallbacks + 1,
+        )
+
+        response = self.client.get("/metrics")
+        self.assert200(response)
+        self.assertIn(
+            b'airtickets_request_duration_seconds_count{endpoint="get_cities"}',
+            response.data,
+        )
+        self.assertIn(b'airtickets_db_pool_connections{state="idle"}', response.data)
+
+    def test_routes_query_timeout(self):
+        with mock.patch(
+            "app.models.Route.get_path", side_effect=QueryTimeout("route_path")
+        ):
+            response = self.client.get("/ajax/routes?from_airport=1&to_airport=2")
+        self.assertStatus(response, 503)
+        self.assertEqual(response.headers["Retry-After"], "5")
+
+    def test_pool_timeout(self):
+        with mock.patch(
+            "app.models.Route.get_path", side_effect=PoolTimeout("pool is full")
+        ):
+            response = self.client.get("/ajax/routes?from_airport=1&to_airport=2")
+        self.assertStatus(response, 503)
+        self.assertEqual(response.headers["Retry-After"], "5")
+
+    def test_stale_namespaces(self):
+        url = "/ajax/autocomplete/cities?query=Lv"
+        self.assert200(self.client.get(url))
+        self.assertEqual(list(redis_store.scan_iter("stale|*")), [])
+
+        # Without a kept copy an overloaded namespace is answered with 503.
+        bump_data_version("cities")
+        limits = {"autocomplete_cities": AdmissionLimit(0, 0)}
+        with mock.patch.dict(admission_limits, limits):
+            self.assertStatus(self.client.get(url), 503)
+
     def test_get_cities_page(self):
         def test():
             response = self.client.get(
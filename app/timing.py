@@ -0,0 +1,134 @@
+"""
+Per-request timing of backend calls, sent in the Server-Timing header.
+
+Wrap a backend call in `timed(name)` to add its duration to the request
+breakdown, `note` and `add_rows` describe what the request did. Outside of
+a request (CLI commands, background threads) they do nothing.
+
+Flask requests keep their timing in `g`, lookups served by the ASGI app
+(app.asgi) in a context variable set by `request_timing`.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+from time import perf_counter
+from typing import Any, Iterator, Optional
+
+from flask import Response, g, has_request_context, request
+
+from app import app
+
+log = logging.getLogger(__name__)
+
+
+class RequestTiming:
+    """Durations of backend calls (in ms) and fields describing a request."""
+
+    def __init__(self) -> None:
+        self.start = perf_counter()
+        self.spans: dict[str, float] = {}
+        self.fields: dict[str, Any] = {}
+
+    def header(self) -> str:
+        """Server-Timing header value, the total is the time since the start."""
+        total = (perf_counter() - self.start) * 1000
+        metrics = [
+            f"{name};dur={duration:.1f}" for name, duration in self.spans.items()
+        ]
+        if "cache" in self.fields:
+            metrics.append(f'cache;desc="{self.fields["cache"]}"')
+        metrics.append(f"total;dur={total:.1f}")
+        return ", ".join(metrics)
+
+    def log(self, path: str, status: int, payload_bytes: Optional[int]) -> None:
+        """Log a JSON line with the breakdown if SERVER_TIMING_LOG is on."""
+        if not app.config["SERVER_TIMING_LOG"]:
+            return
+
+        log.info(
+            json.dumps(
+                {
+                    "path": path,
+                    "status": status,
+                    "total_ms": round((perf_counter() - self.start) * 1000, 1),
+                    "spans_ms": {name: round(d, 1) for name, d in self.spans.items()},
+                    "payload_bytes": payload_bytes,
+                    **self.fields,
+                }
+            )
+        )
+
+
+_asgi_timing: ContextVar[Optional[RequestTiming]] = ContextVar(
+    "asgi_timing", default=None
+)
+
+
+def current_timing() -> Optional[RequestTiming]:
+    """Timing of the current request, None outside of requests."""
+    if has_request_context():
+        return g.setdefault("timing", RequestTiming())
+    return _asgi_timing.get()
+
+
+@contextmanager
+def request_timing() -> Iterator[RequestTiming]:
+    """Time an ASGI request, Flask requests are timed by the hooks below."""
+    timing = RequestTiming()
+    token = _asgi_timing.set(timing)
+    try:
+        yield timing
+    finally:
+        _asgi_timing.reset(token)
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Add duration of the block to the `name` metric of the request."""
+    timing = current_timing()
+    if timing is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        duration = (perf_counter() - start) * 1000
+        timing.spans[name] = timing.spans.get(name, 0.0) + duration
+
+
+def note(**fields: Any) -> None:
+    """Describe the request, e.g. note(cache="miss")."""
+    timing = current_timing()
+    if timing is not None:
+        timing.fields.update(fields)
+
+
+def add_rows(rows: int) -> None:
+    """Count rows fetched by the request."""
+    timing = current_timing()
+    if timing is not None:
+        timing.fields["rows"] = timing.fields.get("rows", 0) + rows
+
+
+@app.before_request
+def start_timer() -> None:
+    g.request_start = perf_counter()
+    g.timing = RequestTiming()
+
+
+@app.after_request
+def server_timing(response: Response) -> Response:
+    """Send the breakdown of /ajax/ requests, optionally log it."""
+    if not request.path.startswith("/ajax/"):
+        return response
+
+    timing = current_timing()
+    response.headers["Server-Timing"] = timing.header()
+    timing.log(request.path, response.status_code, response.calculate_content_length())
+    return response
@@ -1,22 +1,31 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import os
-import pickle
 import math
+from typing import Any, Callable, Optional
 
-from flask import render_template, jsonify, request
+from flask import Response, render_template, jsonify, request
 from elasticsearch.exceptions import (
     NotFoundError,
     ConnectionError as ElasticConnectionError,
 )
-from sqlalchemy.orm import joinedload
-from redis.exceptions import ConnectionError as RedisConnectionError
+from prometheus_client import CONTENT_TYPE_LATEST
+from sqlalchemy.exc import TimeoutError as PoolTimeout
 
-from app import app, redis_store, es
-from app.models import City, CityName, Airport, Route, get_distance
+from app import app, es
+from app.cache import Incomplete, Overloaded, cached
+from app.metrics import BACKEND_FALLBACKS, render as render_metrics
+from app.models import City, CityName, Airport, Route, QueryTimeout, get_distance
+from app.replicas import read_session
+from app.serving import get_store
+from app.timing import add_rows, timed
 
 BASE_TEMPLATES_DIR = os.path.dirname(os.path.abspath(__file__)) + "/templates"
 
+# Threads of the worker for backend lookups that run alongside the request.
+_fanout = ThreadPoolExecutor(app.config["FANOUT_WORKERS"], thread_name_prefix="fanout")
+
 
 @app.context_processor
 def select_parent_template() -> dict[str, str]:
@@ -27,105 +36,47 @@ def select_parent_template() -> dict[str, str]:
     return {"parent_template": parent_template}
 
 
-# Routing.
-
-
-@app.errorhandler(404)
-def page_not_found(_):
-    return render_template("404.html"), 404
-
-
-@app.route("/ajax/")
-@app.route("/")
-def index():
-    """Main page."""
-    return render_template("index.html")
-
-
-@app.route("/ajax/technologies")
-@app.route("/technologies")
-def technologies():
-    """About page."""
-    return render_template("technologies.html")
-
-
-@app.route("/ajax/autocomplete/cities")
-def autocomplete_cities():
-    """Autocomplete for cities."""
-    query = request.args.get("query")
-
-    redis_key = f"autocomplete_cities|{query}"
-
-    # Try to find with Redis.
-    try:
-        result = redis_store.get(redis_key)
-        redis_is_connected = True
-        if result:
-            return jsonify(suggestions=pickle.loads(result))
-    except RedisConnectionError:
-        redis_is_connected = False
-
+@cached("autocomplete_cities")
+def _autocomplete_cities(query: str) -> list[dict]:
+    """Find cities by name prefix."""
     # Try to find with Elasticsearch.
     try:
-        cities = es.search(
-            index="airtickets-city-index",
-            from_=0,
-            size=10,
-            doc_type="CityName",
-            body={
-                "query": {
-                    "bool": {
-                        "must": {"match_phrase_prefix": {"value": {"query": query}}}
-                    }
+        with timed("es"):
+            cities = es.search(
+                index="airtickets-city-index",
+                from_=0,
+                size=10,
+                doc_type="CityName",
+                body={
+                    "query": {
+                        "bool": {
+                            "must": {"match_phrase_prefix": {"value": {"query": query}}}
+                        }
+                    },
+                    "sort": {"population": {"order": "desc"}},
                 },
-                "sort": {"population": {"order": "desc"}},
-            },
-        )
+            )
         result = [city["_source"] for city in cities["hits"]["hits"]]
     except (ElasticConnectionError, NotFoundError, AttributeError):
-        # Try to find with PostgreSQL.
-        cities = (
-            CityName.query.join(City.city)
-            .filter(CityName.name.like(query + "%"))
-            .distinct(City.population, CityName.city_id)
-            .order_by(City.population.desc(), CityName.city_id)
-            .limit(10)
-            .all()
-        )
-
-        result = [city.autocomplete_serialize() for city in cities]
-
-    if redis_is_connected:
-        redis_store.set(redis_key, pickle.dumps(result), 86400)
-
-    return jsonify(suggestions=result)
-
-
-@app.route("/ajax/airports")
-def airports():
-    """Find airports nearby."""
-    lat = float(request.args.get("lat"))
-    lng = float(request.args.get("lng"))
-    limit = int(request.args.get("limit")) or 1
-    find_closest_city = request.args.get("find_closest_city") == "true"
-
-    redis_key = "|".join(
-        ["airports", str(lat), str(lng), str(limit), str(find_closest_city)]
-    )
-
+        BACKEND_FALLBACKS.labels("autocomplete_cities").inc()
+        with timed("serving"):
+            store = get_store()
+            result = store.autocomplete(query) if store else None
+        if result is None:
+            # Try to find with PostgreSQL.
+            with read_session() as session, timed("sql"):
+                cities = session.scalars(CityName.autocomplete_query(query)).all()
+                add_rows(len(cities))
+                result = [city.autocomplete_serialize() for city in cities]
+
+    return result
+
+
+def _closest_city(lat: float, lng: float) -> Optional[dict]:
+    """Find the closest city."""
+    # Try to find with Elasticsearch.
     try:
-        result = redis_store.get(redis_key)
-        redis_is_connected = True
-        if result:
-            return jsonify(pickle.loads(result))
-    except RedisConnectionError:
-        redis_is_connected = False
-
-    result = {"airports": Airport.get_closest_airports(lat, lng, limit)}
-
-    if find_closest_city:
-        # Try to find with Elasticsearch.
-        try:
+        with timed("es"):
             cities = es.search(
                 index="airtickets-city-index",
                 from_=0,
@@ -152,92 +103,93 @@ def airports():
                     "size": 1,
                 },
             )
-            result["closest_city"] = cities["hits"]["hits"][0]["_source"]
-        except (ElasticConnectionError, NotFoundError, AttributeError):
-            result["closest_city"] = next(
-                iter(City.get_closest_cities(lat, lng, 1) or []), None
-            )
-
-    if redis_is_connected:
-        redis_store.set(redis_key, pickle.dumps(result), 86400)
-
-    return jsonify(result)
-
-
-@app.route("/ajax/routes")
-def routes():
-    """Find routes between two airports."""
-    from_airport = int(request.args.get("from_airport"))
-    to_airport = int(request.args.get("to_airport"))
-
-    redis_key = "|".join(["routes", str(from_airport), str(to_airport)])
-
-    try:
-        result = redis_store.get(redis_key)
-        redis_is_connected = True
-        if result:
-            return jsonify(routes=pickle.loads(result))
-    except RedisConnectionError:
-        redis_is_connected = False
+        return cities["hits"]["hits"][0]["_source"]
+    except (ElasticConnectionError, NotFoundError, AttributeError):
+        BACKEND_FALLBACKS.labels("closest_city").inc()
+        return next(iter(City.get_closest_cities(lat, lng, 1) or []), None)
 
-    result = Route.get_path(from_airport, to_airport)
 
-    if redis_is_connected:
-        redis_store.set(redis_key, pickle.dumps(result), 86400)
+def _nearby_airports(lat: float, lng: float, limit: int) -> list[dict]:
+    """Find the closest airports."""
+    with timed("serving"):
+        store = get_store()
+        if store is not None:
+            return store.closest_airports(lat, lng, limit)
+    return Airport.get_closest_airports(lat, lng, limit)
 
-    return jsonify(routes=result)
 
+def _in_app_context(f: Callable, *args: Any) -> Any:
+    with app.app_context():
+        return f(*args)
 
-@app.route("/ajax/get-cities")
-def get_cities():
-    """Get cities in specified area."""
-    ne_lng = float(request.args.get("ne_lng"))
-    ne_lat = float(request.args.get("ne_lat"))
-    sw_lng = float(request.args.get("sw_lng"))
-    sw_lat = float(request.args.get("sw_lat"))
 
-    redis_key = "|".join(
-        ["get_cities", str(ne_lng), str(ne_lat), str(sw_lng), str(sw_lat)]
-    )
+@cached("airports")
+def _closest_airports(
+    lat: float, lng: float, limit: int, find_closest_city: bool
+) -> dict[str, Any] | Incomplete:
+    """Find the closest airports (and the closest city)."""
+    if not find_closest_city:
+        return {"airports": _nearby_airports(lat, lng, limit)}
 
-    # Try to find with Redis.
+    # Look up the city while airports are queried, the lookups are independent.
+    closest_city = _fanout.submit(_in_app_context, _closest_city, lat, lng)
+    result = {"airports": _nearby_airports(lat, lng, limit)}
+    timeout = app.config["CLOSEST_CITY_TIMEOUT"]
     try:
-        result = redis_store.get(redis_key)
-        redis_is_connected = True
-        if result:
-            return jsonify(json_list=pickle.loads(result))
-    except RedisConnectionError:
-        redis_is_connected = False
-
+        # Only the part not overlapped by the airports query.
+        with timed("closest_city"):
+            result["closest_city"] = closest_city.result(timeout)
+    except FutureTimeoutError:
+        # Don't take a fan-out thread if it's still queued.
+        closest_city.cancel()
+        # Answer without the city, don't cache the incomplete result.
+        result["closest_city"] = None
+        return Incomplete(result)
+
+    return result
+
+
+@cached("routes")
+def _routes(from_airport: int, to_airport: int) -> dict[str, dict]:
+    """Find routes between two airports (normalized, see Route.group_paths)."""
+    return Route.get_path(from_airport, to_airport)
+
+
+@cached("get_cities")
+def _cities_in_area(
+    ne_lng: float, ne_lat: float, sw_lng: float, sw_lat: float
+) -> list[dict]:
+    """Find the most populated cities in specified area."""
     # Try to find with Elasticsearch.
     try:
-        cities = es.search(
-            index="airtickets-city-index",
-            from_=0,
-            size=10,
-            doc_type="CityName",
-            body={
-                "query": {
-                    "bool": {
-                        "must": {
-                            "geo_distance": {
-                                "distance": str(
-                                    get_distance(ne_lat, ne_lng, sw_lat, sw_lng)
-                                    / 2
-                                    / math.sqrt(2)
-                                )
-                                + "km",
-                                "location": {
-                                    "lat": (ne_lat + sw_lat) / 2,
-                                    "lon": (ne_lng + sw_lng) / 2,
-                                },
+        with timed("es"):
+            cities = es.search(
+                index="airtickets-city-index",
+                from_=0,
+                size=10,
+                doc_type="CityName",
+                body={
+                    "query": {
+                        "bool": {
+                            "must": {
+                                "geo_distance": {
+                                    "distance": str(
+                                        get_distance(ne_lat, ne_lng, sw_lat, sw_lng)
+                                        / 2
+                                        / math.sqrt(2)
+                                    )
+                                    + "km",
+                                    "location": {
+                                        "lat": (ne_lat + sw_lat) / 2,
+                                        "lon": (ne_lng + sw_lng) / 2,
+                                    },
+                                }
                             }
                         }
-                    }
+                    },
+                    "sort": {"population": {"order": "desc"}},
                 },
-                "sort": {"population": {"order": "desc"}},
-            },
-        )
+            )
 
         result = [
             {
@@ -249,21 +201,110 @@ def get_cities():
             for city in cities["hits"]["hits"]
         ]
     except (ElasticConnectionError, NotFoundError, AttributeError):
-        # Try to find with PostgreSQL.
-        cities = (
-            City.query.options(joinedload(City.city_names))
-            .filter(City.longitude < ne_lng)
-            .filter(City.latitude < ne_lat)
-            .filter(City.longitude > sw_lng)
-            .filter(City.latitude > sw_lat)
-            .order_by(City.population.desc())
-            .limit(10)
-            .all()
-        )
-
-        result = [city.serialize() for city in cities]
-
-    if redis_is_connected:
-        redis_store.set(redis_key, pickle.dumps(result), 86400)
-
-    return jsonify(json_list=result)
+        BACKEND_FALLBACKS.labels("get_cities").inc()
+        with timed("serving"):
+            store = get_store()
+            result = (
+                store.cities_in_area(ne_lng, ne_lat, sw_lng, sw_lat) if store else None
+            )
+        if result is None:
+            # Try to find with PostgreSQL.
+            with read_session() as session, timed("sql"):
+                cities = session.scalars(
+                    City.in_area_query(ne_lng, ne_lat, sw_lng, sw_lat)
+                ).unique()
+                result = [city.serialize() for city in cities]
+                add_rows(len(result))
+
+    return result
+
+
+# Routing.
+
+
+@app.errorhandler(404)
+def page_not_found(_):
+    return render_template("404.html"), 404
+
+
+@app.errorhandler(QueryTimeout)
+def query_timeout(_):
+    """The database is overloaded, let clients retry later."""
+    return jsonify(error="Query timed out, try again later."), 503, {"Retry-After": "5"}
+
+
+@app.errorhandler(Overloaded)
+@app.errorhandler(PoolTimeout)
+def overloaded(_):
+    """Shed the load, cached lookups are still served."""
+    return jsonify(error="Server is busy, try again later."), 503, {"Retry-After": "5"}
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics of all workers."""
+    return Response(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+
+@app.route("/ajax/")
+@app.route("/")
+def index():
+    """Main page."""
+    return render_template("index.html")
+
+
+@app.route("/ajax/technologies")
+@app.route("/technologies")
+def technologies():
+    """About page."""
+    return render_template("technologies.html")
+
+
+@app.route("/ajax/autocomplete/cities")
+def autocomplete_cities():
+    """Autocomplete for cities."""
+    query = request.args.get("query")
+
+    result = _autocomplete_cities(query)
+    with timed("serialize"):
+        return jsonify(suggestions=result)
+
+
+@app.route("/ajax/airports")
+def airports():
+    """Find airports nearby."""
+    lat = float(request.args.get("lat"))
+    lng = float(request.args.get("lng"))
+    limit = int(request.args.get("limit")) or 1
+    find_closest_city = request.args.get("find_closest_city") == "true"
+
+    result = _closest_airports(lat, lng, limit, find_closest_city)
+    with timed("serialize"):
+        return jsonify(result)
+
+
+@app.route("/ajax/routes")
+def routes():
+    """Find routes between two airports."""
+    from_airport = int(request.args.get("from_airport"))
+    to_airport = int(request.args.get("to_airport"))
+
+    result = _routes(from_airport, to_airport)
+    with timed("serialize"):
+        # Paths of airport ids and a map of the airports.
+        if request.args.get("format") == "normalized":
+            return jsonify(result)
+        return jsonify(routes=Route.denormalize_paths(result))
+
+
+@app.route("/ajax/get-cities")
+def get_cities():
+    """Get cities in specified area."""
+    ne_lng = float(request.args.get("ne_lng"))
+    ne_lat = float(request.args.get("ne_lat"))
+    sw_lng = float(request.args.get("sw_lng"))
+    sw_lat = float(request.args.get("sw_lat"))
+
+    result = _cities_in_area(ne_lng, ne_lat, sw_lng, sw_lat)
+    with timed("serialize"):
+        return jsonify(json_list=result)
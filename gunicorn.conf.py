@@ -2,6 +2,10 @@
 Gunicorn config.
 """
 
+import os
+import shutil
+import tempfile
+
 bind = "unix:/uwsgi/airtickets.sock"
 workers = 1
 timeout = 30
@@ -10,3 +14,54 @@ daemon = False
 umask = "91"
 user = "nginx"
 loglevel = "info"
+
+# Serve /ajax/* with asyncio (see app/asgi.py), HTML pages still by Flask:
+# AIRTICKETS_ASGI=1 gunicorn -c gunicorn.conf.py app.asgi:application
+if os.environ.get("AIRTICKETS_ASGI"):
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    # Threads serve cached lookups while others compute misses, computations
+    # are limited by ADMISSION_LIMITS (app/config.py). Keep FANOUT_WORKERS
+    # (app/config.py) equal to threads and the pool (SQLALCHEMY_ENGINE_OPTIONS)
+    # big enough for both.
+    worker_class = "gthread"
+    threads = 8
+
+# Workers write their metrics to PROMETHEUS_MULTIPROC_DIR, /metrics aggregates
+# them (see app/metrics.py). Set it to a runtime directory of the service or a
+# private temporary one is created.
+metrics_tmp_dir = None
+
+
+def on_starting(server):
+    """Prepare the metrics directory, metrics of the previous run are dropped."""
+    global metrics_tmp_dir  # pylint: disable=global-statement
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        for entry in os.scandir(metrics_dir):
+            if entry.name.endswith(".db") and entry.is_file(follow_symlinks=False):
+                os.unlink(entry.path)
+    else:
+        metrics_tmp_dir = tempfile.mkdtemp(prefix="airtickets-metrics-")
+        os.chown(metrics_tmp_dir, server.cfg.uid, server.cfg.gid)
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_tmp_dir
+
+
+def on_exit(server):
+    """Remove the temporary metrics directory."""
+    if metrics_tmp_dir:
+        shutil.rmtree(metrics_tmp_dir, ignore_errors=True)
+
+
+def post_fork(server, worker):
+    """Start loading the serving store (if it's enabled) with the worker."""
+    from app.serving import load_store
+
+    load_store()
+
+
+def child_exit(server, worker):
+    """Stop reporting live gauges of the exited worker."""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
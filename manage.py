@@ -3,26 +3,54 @@ This script provides some easy to use commands.
 """
 
 import csv
-from collections import defaultdict
 from functools import wraps
+from itertools import islice
+import json
 import os
 from time import time
-from typing import Dict, Tuple, Optional
+from typing import Iterator, Optional, TextIO
 
 import click
-from sqlalchemy.orm import joinedload
-from elasticsearch import helpers
-from elasticsearch.exceptions import (
-    NotFoundError,
-    ConnectionError as ElasticConnectionError,
-)
+from elasticsearch.exceptions import ConnectionError as ElasticConnectionError
 
 from app import app, db, es, redis_store
-from app.models import City, CityName, Airline, Airport, Route, get_distance
-
+from app.benchmark import run_benchmark
+from app.cache import bump_data_version
+from app.city_import import import_cities_file, load_populations
+from app.importers import (
+    AIRLINE_COLUMNS,
+    AIRLINE_KEY,
+    AIRPORT_COLUMNS,
+    AIRPORT_KEY,
+    ROUTE_COLUMNS,
+    ROUTE_KEY,
+    airline_row,
+    airport_row,
+    get_airlines_map,
+    get_airports_map,
+    load_rows,
+    route_rows,
+)
+from app.loadtest import (
+    client_sender,
+    http_sender,
+    read_log,
+    run_load,
+    synthetic_workload,
+)
+from app.models import Airport, City
+from app.progress import ImportProgress
+from app.search import reindex_cities
+from app.slow_queries import (
+    SLOW_QUERIES_KEY,
+    load_slow_queries,
+    plan_summary,
+    summarize,
+)
 
 current_dir = os.path.dirname(os.path.realpath(__file__))
-chunk_size = 1000
+chunk_size = 10000
+progress_interval = 5.0  # seconds between progress lines of import commands
 
 
 def timeit(f):
@@ -37,343 +65,318 @@ def timeit(f):
     return wrap
 
 
+@app.cli.command()
+def create_db() -> None:
+    """Create missing tables (workers don't touch the schema on startup)."""
+    db.create_all()
+
+
 @app.cli.command()
 @click.option("--file-name", type=click.Path(), default="csv_data/worldcities.csv")
 @click.option("--rows", type=click.INT, default=None)
-@timeit
-def import_cities(file_name: str, rows: Optional[int]) -> None:
+@click.option("--workers", type=click.INT, default=None)
+@click.option("--incremental", is_flag=True, help="Update changed cities.")
+def import_cities(
+    file_name: str, rows: Optional[int], workers: Optional[int], incremental: bool
+) -> None:
     """Import cities."""
-    city_cache: Dict[Tuple[float, float], Optional[int]] = {}
-    populations_cache = defaultdict(list)
-    _cityname_cache = defaultdict(list)
+    progress = ImportProgress("import_cities", progress_interval)
 
     if file_name[0] != "/":
         file_name = current_dir + "/" + file_name
 
-    # Populate cityname_cache.
-    print("Populate cityname_cache...")
-    with open(file_name, "r", encoding="utf-8") as csvfile:
-        for idx, row in enumerate(csv.DictReader(csvfile)):
-            if rows and idx + 1 > rows:
-                break  # the rows limit was achieved - stop import
-
-            location = (float(row[" latitude"]), float(row[" longitude"]))
-            _cityname_cache[location].append(row[" name"].lower())
-
-        cityname_cache = defaultdict(list)
-        for location, names in _cityname_cache.items():
-            for name in names:
-                cityname_cache[name].extend(
-                    [{"name": n, "location": location} for n in names]
-                )
-
-    # Populate populations_cache.
-    print("Populate populations_cache...")
-    with open(
-        current_dir + "/csv_data/cities-populations.csv", "r", encoding="utf-8"
-    ) as csvfile:
-        csvreader = csv.DictReader(csvfile)
-        for idx, row in enumerate(csvreader):
-            if rows and idx + 1 > rows:
-                break  # the rows limit was achieved - stop import
-
-            if row["Population"]:
-                location = (float(row["Latitude"]), float(row["Longitude"]))
-                for city in cityname_cache[row["City"].lower()]:
-                    if (
-                        abs(city["location"][0] - location[0]) < 0.03
-                        and abs(city["location"][1] - location[1]) < 0.03
-                    ):
-                        populations_cache[city["name"]].append(
-                            {
-                                "latitude": float(row["Latitude"]),
-                                "longitude": float(row["Longitude"]),
-                                "country_code": row["Country"].upper(),
-                                "population": int(row["Population"]),
-                            }
-                        )
-
-    # Create a City.
-    with open(file_name, "r", encoding="utf-8") as csvfile:
-        basket = []
-        for idx, row in enumerate(csv.DictReader(csvfile)):
-            if rows and idx + 1 > rows:
-                break  # the rows limit was achieved - stop import
-
-            location = (float(row[" latitude"]), float(row[" longitude"]))
-            if location not in city_cache:
-                population = [
-                    p["population"]
-                    for p in populations_cache[row[" name"].lower()]
-                    if all(
-                        [
-                            p["country_code"] == row["ISO 3166-1 country code"].upper(),
-                            abs(p["latitude"] - location[0]) < 0.03,
-                            abs(p["longitude"] - location[1]) < 0.03,
-                        ]
-                    )
-                ]
-                population = population[0] if population else 0
-
-                basket.append(
-                    City(
-                        gns_ufi=row[" GNS UFI"] or 0,
-                        latitude=location[0],
-                        longitude=location[1],
-                        country_code=row["ISO 3166-1 country code"],
-                        subdivision_code=row[" FIPS 5-2 subdivision code"],
-                        gns_fd=row[" GNS FD"],
-                        language_code=row[" ISO 639-1 language code"],
-                        population=population,
-                    )
-                )
-                city_cache[location] = None  # avoid adding same cities to database
-                if len(basket) >= chunk_size:
-                    db.session.bulk_save_objects(
-                        basket, return_defaults=True
-                    )  # we need to return ids
-                    db.session.commit()  # save chunk
-
-                    city_cache.update(
-                        {(c.latitude, c.longitude): c.id for c in basket}
-                    )  # set cache
-
-                    basket = []  # empty basket
-
-                print(idx, row[" name"], "(create City)")
-
-        db.session.bulk_save_objects(basket, return_defaults=True)
-        db.session.commit()  # save last chunk
-        city_cache.update(
-            {(c.latitude, c.longitude): c.id for c in basket}
-        )  # set cache
-
-    # Create a CityName.
-    with open(file_name, "r", encoding="utf-8") as csvfile:
-        basket = []
-        for idx, row in enumerate(csv.DictReader(csvfile)):
-            if rows and idx + 1 > rows:
-                break  # the rows limit was achieved - stop import
-
-            location = (float(row[" latitude"]), float(row[" longitude"]))
-
-            basket.append(
-                CityName(
-                    lang=row[" language script"],
-                    city_id=city_cache[location],
-                    name=row[" name"],
-                )
-            )
-            if len(basket) >= chunk_size:
-                db.session.bulk_save_objects(basket)
-                db.session.commit()  # save chunk
-                basket = []  # empty basket
+    with progress.phase("populations"):
+        populations = load_populations(current_dir + "/csv_data/cities-populations.csv")
+
+    with db.engine.begin() as conn:
+        inserted, updated, names_count = import_cities_file(
+            conn,
+            file_name,
+            populations,
+            rows=rows,
+            workers=workers,
+            chunk_size=chunk_size,
+            incremental=incremental,
+            progress=progress,
+        )
+
+    print(inserted, "cities inserted,", updated, "updated,", names_count, "names")
+    progress.report(inserted=inserted, updated=updated, names=names_count)
+
+    if inserted or updated or names_count:
+        bump_data_version("cities")
 
-            print(idx, row[" name"], "(create CityName)")
 
-        db.session.bulk_save_objects(basket)
-        db.session.commit()  # save last chunk
+def _read_csv(
+    csvfile: TextIO, rows: Optional[int], progress: ImportProgress
+) -> Iterator[dict[str, str]]:
+    """Parse CSV rows, time it as the parse phase."""
+    return progress.iterate(islice(csv.DictReader(csvfile), rows), "parse")
 
 
 @app.cli.command()
 @click.option("--file-name", type=click.Path(), default="csv_data/airlines.csv")
 @click.option("--rows", type=click.INT, default=None)
-@timeit
-def import_airlines(file_name: str, rows: Optional[int]) -> None:
+@click.option("--incremental", is_flag=True, help="Upsert changed rows only.")
+def import_airlines(file_name: str, rows: Optional[int], incremental: bool) -> None:
+    """Import airlines."""
+    progress = ImportProgress("import_airlines", progress_interval)
+
     if file_name[0] != "/":
         file_name = current_dir + "/" + file_name
 
-    with open(file_name, "r", encoding="utf-8") as csvfile:
-        csvreader = csv.DictReader(csvfile)
-        for idx, row in enumerate(csvreader):
-            if rows and idx + 1 > rows:
-                # The rows limit was achieved - stop import.
-                break
-
-            # Create Airline.
-            airline = Airline(
-                name=row["Name"],
-                alias=row["Alias"],
-                iata=row["IATA"],
-                icao=row["ICAO"],
-                callsign=row["Callsign"],
-                country=row["Country"],
-                active=row["Active"] == "Y",
-            ).save(idx % chunk_size == 0)
-
-            print(idx, airline.name)
+    with open(file_name, "r", encoding="utf-8") as csvfile, db.engine.begin() as conn:
+        with progress.phase("db_write"):
+            inserted, updated = load_rows(
+                conn,
+                "airline",
+                AIRLINE_COLUMNS,
+                AIRLINE_KEY,
+                progress.iterate(
+                    map(airline_row, _read_csv(csvfile, rows, progress)),
+                    "transform",
+                    count=True,
+                ),
+                incremental=incremental,
+            )
 
-        db.session.commit()  # save last chunk
+    print(inserted, "airlines inserted,", updated, "updated")
+    progress.report(inserted=inserted, updated=updated)
 
 
 @app.cli.command()
 @click.option("--file-name", type=click.Path(), default="csv_data/airports.csv")
-@timeit
-def import_airports(file_name: str) -> None:
+@click.option("--rows", type=click.INT, default=None)
+@click.option("--incremental", is_flag=True, help="Upsert changed rows only.")
+def import_airports(file_name: str, rows: Optional[int], incremental: bool) -> None:
+    """Import airports."""
+    progress = ImportProgress("import_airports", progress_interval)
+
     if file_name[0] != "/":
         file_name = current_dir + "/" + file_name
 
-    with open(file_name, "r", encoding="utf-8") as csvfile:
-        csvreader = csv.DictReader(csvfile)
-        for idx, row in enumerate(csvreader):
-            # Create Airline.
-            airport = Airport(
-                airport_name=row["Name"],
-                city=row["City"],
-                country=row["Country"],
-                iata_faa=row["IATA/FAA"],
-                icao=row["ICAO"],
-                latitude=row["Latitude"],
-                longitude=row["Longitude"],
-                timezone=row["Timezone"],
-                dst=row["DST"],
-                tz_database_time_zone=row["Tz database time zone"],
-            ).save(idx % chunk_size == 0)
+    with open(file_name, "r", encoding="utf-8") as csvfile, db.engine.begin() as conn:
+        with progress.phase("db_write"):
+            inserted, updated = load_rows(
+                conn,
+                "airport",
+                AIRPORT_COLUMNS,
+                AIRPORT_KEY,
+                progress.iterate(
+                    map(airport_row, _read_csv(csvfile, rows, progress)),
+                    "transform",
+                    count=True,
+                ),
+                incremental=incremental,
+            )
 
-            print(idx, airport.airport_name)
+    print(inserted, "airports inserted,", updated, "updated")
+    progress.report(inserted=inserted, updated=updated)
 
-        db.session.commit()  # save last chunk
+    if inserted or updated:
+        bump_data_version("airports")
 
 
 @app.cli.command()
 @click.option("--file-name", type=click.Path(), default="csv_data/routes.csv")
-@timeit
-def import_routes(file_name: str) -> None:
+@click.option("--rows", type=click.INT, default=None)
+@click.option("--incremental", is_flag=True, help="Upsert changed rows only.")
+def import_routes(file_name: str, rows: Optional[int], incremental: bool) -> None:
     """Import routes."""
-    airlines_cache = {}
-    airports_cache = {}
+    progress = ImportProgress("import_routes", progress_interval)
 
     if file_name[0] != "/":
         file_name = current_dir + "/" + file_name
 
-    with open(file_name, "r", encoding="utf-8") as csvfile:
-        csvreader = csv.DictReader(csvfile)
-        for idx, row in enumerate(csvreader):
-            if not all(
-                [row["Source airport"], row["Destination airport"], row["Airline"]]
-            ):
-                print("incorrect row")
-                continue
-
-            if row["Airline"] in airlines_cache:
-                airline_id = airlines_cache[row["Airline"]]
-            else:
-                airline = Airline.query.filter(Airline.iata == row["Airline"]).first()
-                airline_id = getattr(airline, "id", None)
-                airlines_cache[row["Airline"]] = airline_id
-
-            if not airline_id:
-                print("no airline", row["Airline"])
-                continue
-
-            if row["Source airport"] in airports_cache:
-                source_airport = airports_cache[row["Source airport"]]
-            else:
-                source_airport = Airport.query.filter(
-                    Airport.iata_faa == row["Source airport"]
-                ).first()
-                airports_cache[row["Source airport"]] = source_airport
-
-            if not source_airport:
-                print("no source_airport", row["Source airport"])
-                continue
-
-            if row["Destination airport"] in airports_cache:
-                destination_airport = airports_cache[row["Destination airport"]]
-            else:
-                destination_airport = Airport.query.filter(
-                    Airport.iata_faa == row["Destination airport"]
-                ).first()
-                airports_cache[row["Destination airport"]] = destination_airport
-
-            if not destination_airport:
-                print("no destination_airport", row["Destination airport"])
-                continue
-
-            # Create Route.
-            Route(
-                source=source_airport.id,
-                destination=destination_airport.id,
-                airline=airline_id,
-                distance=get_distance(
-                    source_airport.latitude,
-                    source_airport.longitude,
-                    destination_airport.latitude,
-                    destination_airport.longitude,
+    with open(file_name, "r", encoding="utf-8") as csvfile, db.engine.begin() as conn:
+        # Resolve airlines and airports codes in memory.
+        with progress.phase("fk_resolution"):
+            airlines = get_airlines_map(conn)
+            airports = get_airports_map(conn)
+
+        with progress.phase("db_write"):
+            inserted, updated = load_rows(
+                conn,
+                "route",
+                ROUTE_COLUMNS,
+                ROUTE_KEY,
+                progress.iterate(
+                    route_rows(
+                        _read_csv(csvfile, rows, progress),
+                        airlines,
+                        airports,
+                        progress.rejected,
+                    ),
+                    "transform",
+                    count=True,
                 ),
-                codeshare=row["Codeshare"] == "Y",
-                equipment=row["Equipment"],
-            ).save(idx % chunk_size == 0)
-
-            print(
-                idx, source_airport.airport_name, "-", destination_airport.airport_name
+                incremental=incremental,
             )
 
-        db.session.commit()  # save last chunk
+    print(inserted, "routes inserted,", updated, "updated")
+    progress.report(inserted=inserted, updated=updated)
+
+    if inserted or updated:
+        bump_data_version("routes")
 
 
 @app.cli.command()
-def create_cities_index() -> None:
-    items_per_page = 1000
-
-    index_body = {
-        "settings": {
-            "index": {
-                "analysis": {
-                    "analyzer": {
-                        "folding": {
-                            "tokenizer": "standard",
-                            "filter": ["lowercase", "asciifolding"],
-                        }
-                    }
-                }
-            }
-        },
-        "mappings": {
-            "CityName": {
-                "properties": {
-                    "value": {"type": "text", "analyzer": "folding"},
-                    "location": {"type": "geo_point"},
-                    "population": {"type": "integer"},
-                    "data": {"type": "nested"},
-                }
-            }
-        },
-    }
+@click.option("--threads", type=click.INT, default=4)
+@click.option("--keep-old", is_flag=True, help="Don't delete previous indexes.")
+@timeit
+def create_cities_index(threads: int, keep_old: bool) -> None:
+    """Reindex city names into a new index and swap the alias without downtime."""
+    if es is None:
+        print("Elasticsearch is not configured")
+        return
 
     try:
-        es.indices.delete(index="airtickets-city-index")
-    except (ElasticConnectionError, NotFoundError, AttributeError):
+        with db.engine.connect() as conn:
+            index, indexed, failed = reindex_cities(
+                es, conn, thread_count=threads, keep_old=keep_old
+            )
+    except ElasticConnectionError:
+        print("Elasticsearch is not available")
         return
-    es.indices.create(index="airtickets-city-index", body=index_body)
-
-    num_of_items = CityName.query.count()
-    num_of_pages = num_of_items // items_per_page + 1
-    for page in range(num_of_pages):
-        docs = []
-        for city_name in (
-            CityName.query.options(joinedload(CityName.city))
-            .offset(page * items_per_page)
-            .limit(items_per_page)
-            .all()
-        ):
-            docs.append(city_name.elastic_serialize())
-        helpers.bulk(es, docs)
-        print(page, "from", num_of_pages)
+
+    print(indexed, "city names indexed,", failed, "failed, alias points to", index)
+
+
+@app.cli.command()
+@click.pass_context
+@click.option("--incremental", is_flag=True, help="Upsert changed rows only.")
+def import_all(ctx: click.Context, incremental: bool) -> None:
+    ctx.invoke(create_db)
+    ctx.invoke(import_cities, incremental=incremental)
+    ctx.invoke(import_airlines, incremental=incremental)
+    ctx.invoke(import_airports, incremental=incremental)
+    ctx.invoke(import_routes, incremental=incremental)
 
 
 @app.cli.command()
 @click.pass_context
-def import_all(ctx: click.Context) -> None:
-    ctx.invoke(import_cities)
-    ctx.invoke(import_airlines)
-    ctx.invoke(import_airports)
-    ctx.invoke(import_routes)
+@click.option("--repeat", type=click.INT, default=20, help="Samples per case.")
+@click.option("--output", type=click.Path(), default=None, help="JSON report file.")
+def benchmark(ctx: click.Context, repeat: int, output: Optional[str]) -> None:
+    """Time the hot query paths and /ajax views, import csv_data if needed."""
+    ctx.invoke(create_db)
+    if not db.session.query(Airport.id).first():
+        ctx.invoke(import_airlines)
+        ctx.invoke(import_airports)
+        ctx.invoke(import_routes)
+    cities_file = current_dir + "/csv_data/worldcities.csv"
+    if not db.session.query(City.id).first() and os.path.exists(cities_file):
+        ctx.invoke(import_cities)
+
+    report = run_benchmark(repeat)
+
+    if output is None:
+        output = f"{current_dir}/reports/benchmark-{int(time())}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in report["results"].items():
+        if "error" in result:
+            print(f"{name}: {result['error']}")
+        else:
+            statuses = result.get("statuses", [200])
+            print(
+                f"{name}: median {result['median_ms']} ms, p95 {result['p95_ms']} ms"
+                + (f", statuses {statuses}" if statuses != [200] else "")
+            )
+    print("Report saved to", output)
+
+
+def _loadtest_urls(log: Optional[str], count: int, zipf: float, seed: int) -> list[str]:
+    """URLs of the log or of a synthetic workload of the imported airports."""
+    if log:
+        with open(log, "r", encoding="utf-8") as f:
+            return list(islice(read_log(f), count))
+
+    with db.engine.connect() as conn:
+        airport_ids = {code: row[0] for code, row in get_airports_map(conn).items()}
+    return synthetic_workload(
+        current_dir + "/csv_data/airports.csv", airport_ids, count, zipf, seed
+    )
+
+
+@app.cli.command()
+@click.option("--log", type=click.Path(), default=None, help="Request log to replay.")
+@click.option("--requests", "count", type=click.INT, default=1000)
+@click.option("--rate", type=click.FLOAT, default=50.0, help="0 is unlimited.")
+@click.option("--concurrency", type=click.INT, default=8)
+@click.option("--base-url", default=None, help="Server URL, the app otherwise.")
+@click.option("--zipf", type=click.FLOAT, default=1.1, help="Popularity skew.")
+@click.option("--seed", type=click.INT, default=0)
+@click.option("--output", type=click.Path(), default=None, help="JSON report file.")
+def loadtest(
+    *,
+    log: Optional[str],
+    count: int,
+    rate: float,
+    concurrency: int,
+    base_url: Optional[str],
+    zipf: float,
+    seed: int,
+    output: Optional[str],
+) -> None:
+    """Replay /ajax requests of a log or a synthetic workload."""
+    urls = _loadtest_urls(log, count, zipf, seed)
+    send = http_sender(base_url.rstrip("/")) if base_url else client_sender()
+    report = run_load(urls, send, rate or None, concurrency)
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    print(len(urls), "requests in", report["duration_s"], "sec")
+    for name, stats in [*report["endpoints"].items(), ("total", report.get("total"))]:
+        if stats:
+            print(
+                f"{name}: {stats['requests']} requests, {stats['errors']} errors, "
+                f"{stats['throughput']} req/s, p50 {stats['p50_ms']} ms, "
+                f"p95 {stats['p95_ms']} ms, p99 {stats['p99_ms']} ms"
+            )
+
+
+@app.cli.command()
+@click.option("--limit", type=click.INT, default=10, help="Query shapes to show.")
+@click.option("--plans", is_flag=True, help="Print the full EXPLAIN plans.")
+@click.option("--clear", is_flag=True, help="Remove captured queries after.")
+def slow_queries(limit: int, plans: bool, clear: bool) -> None:
+    """Summarize captured slow queries by shape, the worst first."""
+    records = load_slow_queries()
+    print(len(records), "slow queries captured")
+
+    for shape in summarize(records)[:limit]:
+        print()
+        print(
+            f"{shape['count']} calls ({shape['cancelled']} cancelled), "
+            f"total {round(shape['total_ms'], 1)} ms, "
+            f"avg {shape['avg_ms']} ms, max {shape['max_ms']} ms"
+        )
+        print(shape["shape"])
+        print("slowest parameters:", json.dumps(shape["slowest_parameters"]))
+        if "plan" in shape:
+            print("plan:", plan_summary(shape["plan"]))
+            if plans:
+                print(json.dumps(shape["plan"], indent=2))
+
+    if clear:
+        redis_store.delete(SLOW_QUERIES_KEY)
 
 
 @app.cli.command()
 def cleanup_redis():
-    redis_store.flushall()
+    """Remove keys of the app Redis database (other databases are kept)."""
+    # Data versions restarting from 0 would make old ETags valid again.
+    keys = (
+        key
+        for key in redis_store.scan_iter(count=1000)
+        if not key.startswith(b"data_version|")
+    )
+    while batch := list(islice(keys, 1000)):
+        redis_store.delete(*batch)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+"""Natural keys and checksums for incremental imports
+
+Existing airlines and airports don't get source_id: the old importer didn't
+keep IDs of the data feed, so they can't be backfilled. Re-import them from
+scratch after the upgrade, --incremental imports would add them again:
+
+    TRUNCATE route, airport, airline RESTART IDENTITY;
+    python manage.py import-airlines
+    python manage.py import-airports
+    python manage.py import-routes
+
+Revision ID: 7c1f0e9a4b2d
+Revises: 522b80e2efa7
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+log = logging.getLogger('alembic.runtime.migration')
+
+# revision identifiers, used by Alembic.
+revision = '7c1f0e9a4b2d'
+down_revision = '522b80e2efa7'
+
+
+def upgrade():
+    # pylint: disable=E1101
+    for table in ('airline', 'airport', 'route', 'city'):
+        op.add_column(table, sa.Column('checksum', sa.String(length=32), nullable=True))
+    op.add_column('airline', sa.Column('source_id', sa.Integer(), nullable=True))
+    op.create_unique_constraint('airline_source_id_key', 'airline', ['source_id'])
+    op.add_column('airport', sa.Column('source_id', sa.Integer(), nullable=True))
+    op.create_unique_constraint('airport_source_id_key', 'airport', ['source_id'])
+    # The old importer added the same route again on every run, keep the first.
+    op.execute(
+        'DELETE FROM route AS r USING route AS d '
+        'WHERE r.source = d.source AND r.destination = d.destination '
+        'AND r.airline = d.airline AND r.id > d.id'
+    )
+    op.create_unique_constraint('route_key', 'route', ['source', 'destination', 'airline'])
+
+    bind = op.get_bind()
+    for table in ('airline', 'airport'):
+        if bind.execute(sa.text(f'SELECT EXISTS (SELECT 1 FROM {table})')).scalar():
+            log.warning('%s rows have no source_id, re-import them from scratch', table)
+
+
+def downgrade():
+    # pylint: disable=E1101
+    op.drop_constraint('route_key', 'route')
+    op.drop_constraint('airport_source_id_key', 'airport')
+    op.drop_column('airport', 'source_id')
+    op.drop_constraint('airline_source_id_key', 'airline')
+    op.drop_column('airline', 'source_id')
+    for table in ('airline', 'airport', 'route', 'city'):
+        op.drop_column(table, 'checksum')